@@ -18,10 +18,16 @@ class Env:
         'SC23DCI_IP'
     ]
 
+    # required keys that are not needed when one of the alternative keys is set
+    alternative_keys = {
+        'SC23DCI_IP': ['SC23DCI_FLEET_FILE', 'SC23DCI_DISCOVERY_CIDR']
+    }
+
     optional_keys = {
         'MQTT_BROKER_PORT': 1883,
         'MQTT_TOPIC_TEMPERATURE': 'sc23dci/sensors/temperature/ac',
         'MQTT_TOPIC_ALL': 'sc23dci/all',
+        'MQTT_TOPIC_ALL_COMPACT': '',
         'MQTT_TOPIC_POWERSTATE': 'sc23dci/powerstate',
         'MQTT_TOPIC_POWERSTATE_SET': 'sc23dci/powerstate/set',
         'MQTT_TOPIC_MODE_SET': 'sc23dci/mode/set',
@@ -32,13 +38,41 @@ class Env:
         'MQTT_TOPIC_FAN_SPEED_SET': 'sc23dci/fan_speed/set',
         'MQTT_TOPIC_NIGHT_MODE_SET': 'sc23dci/night_mode/set',
         'MQTT_TOPIC_LWT': 'sc23dci/lwt',
+        'MQTT_TOPIC_BROADCAST_SET': 'sc23dci/broadcast/set',
+        'MQTT_TOPIC_GROUP_SET': 'sc23dci/group/+/set',
+        'MQTT_TOPIC_BROADCAST_RESULT': 'sc23dci/broadcast/result',
+        'MQTT_TOPIC_PROFILE_SET': 'sc23dci/profile/set',
+        'MQTT_TOPIC_USAGE': 'sc23dci/usage',
         'MQTT_HASSIO_AUTODETECT': True,
         'MQTT_HASSIO_OBJECT_ID': 'SC23DCI-unique-id-not-set',
         'MQTT_HASSIO_TOPIC': 'homeassistant',
         'SC23DCI_MAX_TEMP_C': 31,
         'SC23DCI_MIN_TEMP_C': 16,
         'SC23DCI_POLL_INTERVAL': 10,
-        'LOG_LEVEL': 'INFO'
+        'SC23DCI_RATE_LIMIT': 2,
+        'SC23DCI_RATE_BURST': 6,
+        'SC23DCI_RATE_MAX_WAIT': 5,
+        'SC23DCI_FULL_REFRESH_INTERVAL': 300,
+        'SC23DCI_RECORD_FILE': '',
+        'SC23DCI_FLEET_FILE': '',
+        'SC23DCI_FLEET_WORKERS': 1,
+        'SC23DCI_BROADCAST_PARALLELISM': 16,
+        'SC23DCI_SCHEDULER_WORKERS': 10,
+        'SC23DCI_USAGE_DIR': '/var/log',
+        'SC23DCI_USAGE_MAX_GAP': 300,
+        'SC23DCI_USAGE_PUBLISH_INTERVAL': 300,
+        'SC23DCI_LOG_SAMPLE_INTERVAL': 300,
+        'SC23DCI_PROFILE_DIR': '/var/log',
+        'SC23DCI_PROFILE_DURATION': 30,
+        'SC23DCI_PROFILE_MAX_DURATION': 300,
+        'SC23DCI_DISCOVERY_CIDR': '',
+        'SC23DCI_DISCOVERY_CACHE': '/var/log/sc23dci-discovery.json',
+        'SC23DCI_DISCOVERY_WORKERS': 64,
+        'SC23DCI_DISCOVERY_TIMEOUT': 1,
+        'SC23DCI_DISCOVERY_INTERVAL': 60,
+        'SC23DCI_DISCOVERY_AFTER_FAILURES': 3,
+        'LOG_LEVEL': 'INFO',
+        'LOG_JSON': False
     }
 
     @staticmethod
@@ -59,6 +93,19 @@ class Env:
             return str(Env.optional_keys[key])
         raise KeyError('Invalid env key requested')
 
+    @staticmethod
+    def is_set(key: str) -> bool:
+        """
+        Checks if a valid environment variable has a non-empty value, without raising
+        for missing required variables
+        :param key: The name of the variable
+        :raises KeyError: 'Invalid env key requested'
+        :return: True if the variable or its default is not empty
+        """
+        if key not in Env.requiredKeys and key not in Env.optional_keys:
+            raise KeyError('Invalid env key requested')
+        return bool(os.getenv(key, str(Env.optional_keys.get(key, ''))))
+
     @staticmethod
     def check_missing():
         """
@@ -69,6 +116,8 @@ class Env:
         missing_envs = []
         for key in Env.requiredKeys:
             env_key = os.getenv(key)
+            for alternative_key in Env.alternative_keys.get(key, []):
+                env_key = env_key or os.getenv(alternative_key)
             if env_key is None or env_key == '':
                 missing_envs.append(key)
         for env in missing_envs:
@@ -2,14 +2,34 @@
 Run Module
 Starts up the agent
 """
-import datetime
 import sys
 
-from apscheduler.schedulers.blocking import BlockingScheduler  # type: ignore
 from loguru import logger
 
 from env.env import Env
-from sc23dci import sc23dci
+from sc23dci import fleet, sc23dci
+from sc23dci.discovery import discovery_from_env
+from sc23dci.profiler import Profiler
+from sc23dci.recorder import Recorder
+from sc23dci.scheduler import Scheduler
+
+
+# the default format of loguru
+LOG_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
+)
+
+
+def log_format(record) -> str:
+    """
+    Appends the structured fields, eg.: device and endpoint, to the default format
+    :param record: The log record
+    :return: The format of the record
+    """
+    if record['extra']:
+        return LOG_FORMAT + " | {extra}\n{exception}"
+    return LOG_FORMAT + "\n{exception}"
 
 
 def set_log_level(level):
@@ -27,32 +47,60 @@ def set_log_level(level):
     if level not in ['TRACE', 'DEBUG', 'INFO', 'SUCCESS', 'WARNING', 'ERROR', 'CRITICAL']:
         level = 'INFO'
     logger.remove()
-    logger.add("/var/log/sc23dci.log", rotation="500 KB", level="INFO")
-    logger.add(sys.stderr, level=level)
+    # enqueue keeps the log file consistent when fleet workers write to it
+    # serialize writes one JSON object per line with the structured fields in extra
+    logger.add(
+        "/var/log/sc23dci.log",
+        rotation="500 KB",
+        level="INFO",
+        enqueue=True,
+        format=log_format,
+        serialize=Env.get_env('LOG_JSON').lower() == 'true'
+    )
+    logger.add(sys.stderr, level=level, format=log_format)
 
 
 if __name__ == '__main__':
     set_log_level(Env.get_env('LOG_LEVEL'))
     Env.check_missing()
 
+    if Env.get_env('SC23DCI_FLEET_FILE') or not Env.is_set('SC23DCI_IP'):
+        logger.info('Starting fleet')
+        fleet.run_fleet(
+            Env.get_env('SC23DCI_FLEET_FILE'),
+            int(Env.get_env('SC23DCI_FLEET_WORKERS'))
+        )
+        sys.exit(0)
+
     logger.info('Creating SC23DCI instance')
-    ac = sc23dci.SC23DCI(Env.get_env('SC23DCI_IP'))
+    record_file = Env.get_env('SC23DCI_RECORD_FILE')
+    ac = sc23dci.SC23DCI(
+        Env.get_env('SC23DCI_IP'),
+        recorder=Recorder(record_file) if record_file else None
+    )
+    discovery = discovery_from_env()
+    if discovery is not None:
+        ac.set_resolver(discovery.resolve)
+
+    profiler = Profiler()
+    profiler.install_signal_handler()
+    ac.mqtt_add_subscription(Env.get_env('MQTT_TOPIC_PROFILE_SET'), profiler.on_mqtt_profile)
 
     logger.info('Creating MqttClient instance')
     ac.set_mqtt_client(Env.get_env('MQTT_BROKER_IP'), Env.get_env('MQTT_BROKER_PORT'))
     ac.mqtt_enable_publish_temperature(Env.get_env('MQTT_TOPIC_TEMPERATURE'))
     ac.mqtt_enable_publish_power_state(Env.get_env('MQTT_TOPIC_POWERSTATE'))
     ac.mqtt_enable_publish_all(Env.get_env('MQTT_TOPIC_ALL'))
+    ac.mqtt_enable_publish_usage(Env.get_env('MQTT_TOPIC_USAGE'))
+    if Env.get_env('MQTT_TOPIC_ALL_COMPACT'):
+        ac.mqtt_enable_publish_all_compact(Env.get_env('MQTT_TOPIC_ALL_COMPACT'))
 
     logger.info('Scheduler initialization started')
-    taskScheduler = scheduler = BlockingScheduler(daemon=True)
-    job = taskScheduler.add_job(
-        ac.refresh,
-        'interval',
-        seconds=int(Env.get_env('SC23DCI_POLL_INTERVAL')),
-        next_run_time=datetime.datetime.now()
-    )
+    scheduler = Scheduler()
+    scheduler.add_job('refresh', ac.refresh, int(Env.get_env('SC23DCI_POLL_INTERVAL')))
+    scheduler.install_signal_handler()
 
     logger.info('Service started successful')
     logger.info('Service is running')
-    taskScheduler.start()
+    scheduler.start()
+    logger.info('Service stopped')
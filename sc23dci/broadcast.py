@@ -0,0 +1,240 @@
+"""
+Broadcast Module
+Fans out commands to all devices or tagged groups of devices of a fleet
+"""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.queues import Queue
+
+import paho.mqtt.publish as mqtt_publish
+from loguru import logger
+
+from env.env import Env
+from sc23dci.sc23dci import SC23DCI
+
+
+def group_level() -> int:
+    """
+    The level of the group in MQTT_TOPIC_GROUP_SET, checked once at startup
+    :raises ValueError: The topic has no + level
+    :return: The index of the + level. eg.: 2 for sc23dci/group/+/set
+    """
+    topic = Env.get_env('MQTT_TOPIC_GROUP_SET')
+    levels = topic.split('/')
+    if '+' not in levels:
+        raise ValueError(f"MQTT_TOPIC_GROUP_SET {topic} has no + level for the group")
+    return levels.index('+')
+
+
+def publish_report(report: dict):
+    """
+    Publishes a report on MQTT_TOPIC_BROADCAST_RESULT with a short-lived connection
+    :param report: The report
+    """
+    try:
+        mqtt_publish.single(
+            Env.get_env('MQTT_TOPIC_BROADCAST_RESULT'),
+            payload=json.dumps(report),
+            hostname=Env.get_env('MQTT_BROKER_IP'),
+            port=int(Env.get_env('MQTT_BROKER_PORT')),
+            client_id='sc23dci-supervisor'
+        )
+    except OSError as e:
+        logger.error(f"Broadcast report {report['id']} not published: {e}")
+
+
+class ReportAggregator:
+    """
+    Merges the reports of the workers of a fleet into one report per broadcast.
+    Reports are matched by the id, the group and the commands of the broadcast.
+    A report is complete when every running worker reported or after timeout seconds.
+    """
+
+    def __init__(self, timeout: float = 60):
+        """
+        :param timeout: The time in seconds to wait for the reports of all workers
+        """
+        self.timeout = timeout
+        self.pending: dict[str, dict] = {}
+
+    def add(self, key: str, report: dict, workers: int) -> dict | None:
+        """
+        Adds the report of a worker
+        :param key: Identifies the broadcast
+        :param report: The report of the worker
+        :param workers: The number of running workers
+        :return: The merged report when all workers reported, else None
+        """
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = {
+                'report': {
+                    'id': report['id'],
+                    'group': report['group'],
+                    'workers': [],
+                    'devices': 0,
+                    'succeeded': 0,
+                    'failed': [],
+                    'duration': 0.0
+                },
+                'expected': workers,
+                'deadline': time.monotonic() + self.timeout
+            }
+            self.pending[key] = pending
+        merged = pending['report']
+        merged['workers'] += report['workers']
+        merged['devices'] += report['devices']
+        merged['succeeded'] += report['succeeded']
+        merged['failed'] += report['failed']
+        merged['duration'] = max(merged['duration'], report['duration'])
+        if len(merged['workers']) < pending['expected']:
+            return None
+        del self.pending[key]
+        return merged
+
+    def expired(self) -> list[dict]:
+        """
+        Takes the reports whose workers did not all report in time
+        :return: The incomplete merged reports
+        """
+        now = time.monotonic()
+        expired = [key for key, pending in self.pending.items() if pending['deadline'] <= now]
+        reports = []
+        for key in expired:
+            pending = self.pending.pop(key)
+            logger.warning(
+                f"Broadcast {pending['report']['id']}: {len(pending['report']['workers'])} of "
+                f"{pending['expected']} workers reported"
+            )
+            reports.append(pending['report'])
+        return reports
+
+
+class Broadcaster:
+    """
+    Applies commands received on the broadcast and group topics to many devices concurrently
+    and publishes one report per command.
+    The payload is a JSON object of commands, see SC23DCI.apply_command, and an optional id
+    that is returned in the report. eg.: {"id": "closing", "power_state": "off"}
+    """
+
+    def __init__(self, worker: int, parallelism: int, reports: Queue | None = None):
+        """
+        :param worker: The index of the worker, returned in the report
+        :param parallelism: The maximum number of devices commanded at the same time
+        :param reports: The queue the reports are sent to the supervisor, which merges and
+        publishes them. None publishes the report of this worker
+        :raises ValueError: MQTT_TOPIC_GROUP_SET has no + level
+        """
+        self.worker = worker
+        self.reports = reports
+        self.group_level = group_level()
+        self.devices: list[tuple[SC23DCI, set[str]]] = []
+        self.executor = ThreadPoolExecutor(
+            max_workers=parallelism,
+            thread_name_prefix='sc23dci-broadcast'
+        )
+        self.mqtt_client = None
+
+    def add_device(self, device: SC23DCI, tags: list[str]):
+        """
+        Adds a device that receives broadcasts
+        :param device: The device
+        :param tags: The groups of the device
+        """
+        self.devices.append((device, set(tags)))
+
+    def subscribe(self, client):
+        """
+        Subscribes to the broadcast and group topics
+        :param client: The connected MQTT client
+        """
+        self.mqtt_client = client
+        for topic in [Env.get_env('MQTT_TOPIC_BROADCAST_SET'), Env.get_env('MQTT_TOPIC_GROUP_SET')]:
+            client.subscribe(topic)
+            client.message_callback_add(topic, self.on_mqtt_broadcast)
+
+    def group_of(self, topic: str) -> str | None:
+        """
+        Extracts the group of a group topic
+        :param topic: The topic of the message
+        :return: The group or None for the broadcast topic
+        """
+        if topic == Env.get_env('MQTT_TOPIC_BROADCAST_SET'):
+            return None
+        return topic.split('/')[self.group_level]
+
+    def on_mqtt_broadcast(self, client, userdata, msg):  # pylint: disable=unused-argument
+        """
+        The callback of the broadcast and group topics.
+        The commands are applied in a separate thread to keep the MQTT loop responsive.
+        :param client: The MQTT client
+        :param userdata:
+        :param msg: The message with payload
+        """
+        try:
+            commands = json.loads(msg.payload)
+            if not isinstance(commands, dict):
+                raise ValueError('payload is not a JSON object')
+        except ValueError as e:
+            logger.error(f"Invalid broadcast on {msg.topic}: {e}")
+            return
+        threading.Thread(
+            target=self.broadcast,
+            args=(self.group_of(msg.topic), commands),
+            daemon=True
+        ).start()
+
+    def broadcast(self, group: str | None, commands: dict) -> dict:
+        """
+        Applies the commands to all devices of the group and publishes the report
+        :param group: The group or None for all devices
+        :param commands: The commands by name and the optional id
+        :return: The report
+        """
+        start = time.monotonic()
+        key = json.dumps([group, commands], sort_keys=True)
+        command_id = commands.pop('id', None)
+        targets = [device for device, tags in self.devices if group is None or group in tags]
+        futures = {
+            device.device_id: self.executor.submit(self.apply, device, commands)
+            for device in targets
+        }
+        failed = [device_id for device_id, future in futures.items() if not future.result()]
+        report = {
+            'id': command_id,
+            'group': group,
+            'workers': [self.worker],
+            'devices': len(targets),
+            'succeeded': len(targets) - len(failed),
+            'failed': failed,
+            'duration': round(time.monotonic() - start, 3)
+        }
+        logger.info(f"Broadcast {command_id} to {group or 'all'}: {report}")
+        if self.reports is not None:
+            self.reports.put((key, report))
+        elif self.mqtt_client is not None:
+            self.mqtt_client.publish(
+                Env.get_env('MQTT_TOPIC_BROADCAST_RESULT'),
+                payload=json.dumps(report)
+            )
+        return report
+
+    @staticmethod
+    def apply(device: SC23DCI, commands: dict) -> bool:
+        """
+        Applies the commands to one device
+        :param device: The device
+        :param commands: The commands by name
+        :return: True if all commands succeeded
+        """
+        succeeded = True
+        for command, value in commands.items():
+            try:
+                succeeded = device.apply_command(command, value) and succeeded
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.error(f"Broadcast {command} to {device.device_id} failed: {e}")
+                succeeded = False
+        return succeeded
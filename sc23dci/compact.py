@@ -0,0 +1,199 @@
+"""
+Compact Module
+Short-key CBOR (RFC 8949) encoding of the summary for machine consumers
+"""
+import struct
+from typing import Any
+
+# summary keys of the all topic and their short keys
+SHORT_KEYS = {
+    'set_point': 'sp',
+    'working_mode': 'wm',
+    'power_state': 'ps',
+    'mode': 'm',
+    'fan_speed': 'fs',
+    'flap_rotate': 'fr',
+    'timeplan_mode': 'cm',
+    'temperature': 't',
+    'night_mode': 'nm',
+    'timer_status': 'ts',
+    'heating_disabled': 'hd',
+    'cooling_disabled': 'cd',
+    'hotel_mode': 'hm',
+    'uptime': 'up',
+    'software_version': 'sw',
+    'time': 'tm',
+    'uid': 'id',
+    'device_type': 'dt',
+    'ip': 'ip',
+    'subnet': 'sn',
+    'gateway': 'gw',
+    'dhcp': 'dh',
+    'serial': 'sr',
+    'name': 'n',
+    'wifi': 'wf',
+    'suppressed_writes': 'sup'
+}
+LONG_KEYS = {short: key for key, short in SHORT_KEYS.items()}
+
+
+def encode_head(major: int, value: int) -> bytes:
+    """
+    Encodes the initial bytes of a CBOR data item
+    :param major: The major type 0-7
+    :param value: The argument, eg. the length or the integer value
+    :return: The encoded head
+    """
+    if value < 24:
+        return bytes([major << 5 | value])
+    if value < 0x100:
+        return bytes([major << 5 | 24, value])
+    if value < 0x10000:
+        return bytes([major << 5 | 25]) + struct.pack('>H', value)
+    if value < 0x100000000:
+        return bytes([major << 5 | 26]) + struct.pack('>I', value)
+    return bytes([major << 5 | 27]) + struct.pack('>Q', value)
+
+
+def cbor_encode(value: Any) -> bytes:  # pylint: disable=too-many-return-statements
+    """
+    Encodes None, bool, int, float, str, bytes, list, tuple and dict as CBOR
+    :param value: The value to encode
+    :raises TypeError: Unsupported type
+    :return: The CBOR encoded value
+    """
+    if value is None:
+        return b'\xf6'
+    if value is True:
+        return b'\xf5'
+    if value is False:
+        return b'\xf4'
+    if isinstance(value, int):
+        return encode_head(0, value) if value >= 0 else encode_head(1, -1 - value)
+    if isinstance(value, float):
+        try:
+            single = struct.pack('>f', value)
+            if struct.unpack('>f', single)[0] == value:
+                return b'\xfa' + single
+        except OverflowError:
+            pass
+        return b'\xfb' + struct.pack('>d', value)
+    if isinstance(value, str):
+        encoded = value.encode('utf-8')
+        return encode_head(3, len(encoded)) + encoded
+    if isinstance(value, bytes):
+        return encode_head(2, len(value)) + value
+    if isinstance(value, (list, tuple)):
+        return encode_head(4, len(value)) + b''.join(cbor_encode(item) for item in value)
+    if isinstance(value, dict):
+        return encode_head(5, len(value)) + b''.join(
+            cbor_encode(key) + cbor_encode(item) for key, item in value.items()
+        )
+    raise TypeError(f"Type {type(value).__name__} is not CBOR serializable")
+
+
+def read(data: bytes, offset: int, size: int) -> bytes:
+    """
+    Reads bytes of a CBOR data item
+    :param data: The CBOR encoded data
+    :param offset: The offset of the bytes
+    :param size: The number of bytes
+    :raises ValueError: The data ends before
+    :return: The bytes
+    """
+    if offset + size > len(data):
+        raise ValueError(f"Truncated CBOR data, {size} bytes expected at offset {offset}")
+    return data[offset:offset + size]
+
+
+# pylint: disable-next=too-many-return-statements, too-many-branches
+def cbor_decode_item(data: bytes, offset: int) -> tuple[Any, int]:
+    """
+    Decodes the CBOR data item at the offset
+    :param data: The CBOR encoded data
+    :param offset: The offset of the item
+    :raises ValueError: Unsupported, invalid or truncated CBOR
+    :return: The decoded value and the offset of the next item
+    """
+    initial = read(data, offset, 1)[0]
+    major, info = initial >> 5, initial & 0x1f
+    offset += 1
+    if major == 7:
+        simple = {20: False, 21: True, 22: None}
+        if info in simple:
+            return simple[info], offset
+        if info == 26:
+            return struct.unpack('>f', read(data, offset, 4))[0], offset + 4
+        if info == 27:
+            return struct.unpack('>d', read(data, offset, 8))[0], offset + 8
+        raise ValueError(f"Unsupported CBOR simple value {info}")
+    if info < 24:
+        value = info
+    elif info <= 27:
+        size = 1 << (info - 24)
+        value = int.from_bytes(read(data, offset, size), 'big')
+        offset += size
+    else:
+        raise ValueError('Indefinite length CBOR is not supported')
+    if major == 0:
+        return value, offset
+    if major == 1:
+        return -1 - value, offset
+    if major == 2:
+        return read(data, offset, value), offset + value
+    if major == 3:
+        # invalid UTF-8 raises UnicodeDecodeError, a ValueError
+        return read(data, offset, value).decode('utf-8'), offset + value
+    if major == 4:
+        items = []
+        for _ in range(value):
+            item, offset = cbor_decode_item(data, offset)
+            items.append(item)
+        return items, offset
+    if major == 5:
+        mapping = {}
+        for _ in range(value):
+            key, offset = cbor_decode_item(data, offset)
+            if isinstance(key, (list, dict)):
+                raise ValueError('Unsupported CBOR map key')
+            mapping[key], offset = cbor_decode_item(data, offset)
+        return mapping, offset
+    raise ValueError('CBOR tags are not supported')
+
+
+def cbor_decode(data: bytes) -> Any:
+    """
+    Decodes CBOR written by cbor_encode
+    :param data: The CBOR encoded data
+    :raises ValueError: Unsupported, invalid or truncated CBOR
+    :return: The decoded value
+    """
+    try:
+        value, offset = cbor_decode_item(data, 0)
+    except RecursionError as e:
+        raise ValueError('CBOR data is nested too deep') from e
+    if offset != len(data):
+        raise ValueError('Trailing bytes after CBOR data item')
+    return value
+
+
+def encode_all(payload: dict) -> bytes:
+    """
+    Encodes the summary of the all topic with short keys as CBOR
+    :param payload: The summary
+    :return: The compact payload
+    """
+    return cbor_encode({SHORT_KEYS.get(key, key): value for key, value in payload.items()})
+
+
+def decode_all(payload: bytes) -> dict:
+    """
+    Decodes a compact payload back to the keys of the all topic
+    :param payload: The compact payload
+    :raises ValueError: The payload is not a CBOR map
+    :return: The summary
+    """
+    summary = cbor_decode(payload)
+    if not isinstance(summary, dict):
+        raise ValueError('Compact payload is not a CBOR map')
+    return {LONG_KEYS.get(key, key): value for key, value in summary.items()}
@@ -0,0 +1,159 @@
+"""
+Discovery Module
+Finds compatible SC23DCI devices in the LAN
+"""
+import ipaddress
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests as req
+from loguru import logger
+
+from env.env import Env
+
+
+def probe(ip: str, timeout: float) -> dict | None:
+    """
+    Checks if a compatible device answers on the ip
+    :param ip: The ip to probe
+    :param timeout: The connect and read timeout in seconds
+    :return: The identity of the device or None
+    """
+    try:
+        res = req.get(f"http://{ip}/api/v/1/status", timeout=timeout)
+        if res.status_code != 200:
+            return None
+        status = res.json()
+        return {
+            'ip': ip,
+            'uid': status['UID'],
+            'device_type': status['deviceType'],
+            'serial': status['setup']['serial'],
+            'name': status['setup']['name'],
+            'seen': time.time()
+        }
+    except (req.RequestException, ValueError, KeyError, TypeError):
+        return None
+
+
+# pylint: disable=too-many-instance-attributes
+class Discovery:
+    """
+    Probes a CIDR range concurrently for the status endpoint.
+    Found devices are cached by UID, so a device can be found again when its ip changed.
+    """
+
+    def __init__(self, cidr: str, cache_path: str, workers: int = 64, timeout: float = 1,
+                 min_interval: float = 60):
+        """
+        :param cidr: The range to scan. eg.: 192.168.1.0/24
+        :param cache_path: The path of the cache file, empty to keep the cache in memory
+        :param workers: The number of concurrent probes
+        :param timeout: The timeout of a probe in seconds
+        :param min_interval: The minimum time in seconds between two scans
+        """
+        self.network = ipaddress.ip_network(cidr, strict=False)
+        self.cache_path = cache_path
+        self.workers = workers
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.last_scan = float('-inf')
+        self.lock = threading.Lock()
+        self.devices: dict[str, dict] = self.load_cache()
+
+    def load_cache(self) -> dict[str, dict]:
+        """
+        Reads the cache file
+        :return: The cached devices by UID
+        """
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            logger.error(f"Discovery cache {self.cache_path} not loaded: {e}")
+            return {}
+
+    def save_cache(self):
+        """
+        Writes the cache file
+        """
+        if not self.cache_path:
+            return
+        # unique per process, so concurrent agents never write the same temporary file
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(self.devices, file)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.error(f"Discovery cache {self.cache_path} not saved: {e}")
+
+    def scan(self) -> dict[str, dict]:
+        """
+        Probes every host of the range. Scans more frequent than min_interval return the cache.
+        :return: The devices by UID
+        """
+        with self.lock:
+            if time.monotonic() - self.last_scan < self.min_interval:
+                return self.devices
+            start = time.monotonic()
+            hosts = [str(host) for host in self.network.hosts()]
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                found = [
+                    device for device in executor.map(lambda ip: probe(ip, self.timeout), hosts)
+                    if device is not None
+                ]
+            for device in found:
+                cached = self.devices.get(device['uid'])
+                if cached is not None and cached['ip'] != device['ip']:
+                    logger.info(
+                        f"Device {device['uid']} moved from {cached['ip']} to {device['ip']}"
+                    )
+                self.devices[device['uid']] = device
+            self.last_scan = time.monotonic()
+            self.save_cache()
+            logger.info(
+                f"Discovered {len(found)} devices in {len(hosts)} hosts of {self.network} "
+                f"in {self.last_scan - start:.1f}s"
+            )
+            return self.devices
+
+    def lookup(self, uid: str) -> str | None:
+        """
+        Looks up the cached ip of a device
+        :param uid: The UID of the device
+        :return: The ip or None
+        """
+        device = self.devices.get(uid)
+        return None if device is None else device['ip']
+
+    def resolve(self, uid: str) -> str | None:
+        """
+        Scans the range and looks up the ip of a device
+        :param uid: The UID of the device
+        :return: The ip or None
+        """
+        self.scan()
+        return self.lookup(uid)
+
+
+def discovery_from_env() -> Discovery | None:
+    """
+    Creates the Discovery configured by the environment
+    :return: The Discovery or None if SC23DCI_DISCOVERY_CIDR is not set
+    """
+    cidr = Env.get_env('SC23DCI_DISCOVERY_CIDR')
+    if not cidr:
+        return None
+    return Discovery(
+        cidr,
+        Env.get_env('SC23DCI_DISCOVERY_CACHE'),
+        int(Env.get_env('SC23DCI_DISCOVERY_WORKERS')),
+        float(Env.get_env('SC23DCI_DISCOVERY_TIMEOUT')),
+        float(Env.get_env('SC23DCI_DISCOVERY_INTERVAL'))
+    )
@@ -0,0 +1,477 @@
+"""
+Fleet Module
+Runs many SC23DCI devices, sharded across worker processes
+"""
+import bisect
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import re
+import signal
+import time
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+from typing import Callable
+
+import paho.mqtt.client as mqtt
+from loguru import logger
+
+from env.env import Env
+from sc23dci.broadcast import Broadcaster, ReportAggregator, group_level, publish_report
+from sc23dci.discovery import Discovery, discovery_from_env
+from sc23dci.profiler import Profiler
+from sc23dci.sc23dci import SC23DCI
+from sc23dci.scheduler import Scheduler
+
+
+def load_fleet(path: str, discovery: bool = False) -> list[dict]:
+    """
+    Reads the fleet file.
+    The file holds a JSON list of devices:
+    - ip: The ip or hostname of the device. Resolved by discovery if not set
+    - id: The id of the device, scopes the MQTT topics. Defaults to uid or ip
+    - uid: The UID of the device, used to shard the fleet and to resolve the ip. Defaults to ip
+    - poll_interval: The poll interval in seconds. Defaults to SC23DCI_POLL_INTERVAL
+    - tags: The groups of the device for group commands
+    :param path: The path of the fleet file
+    :param discovery: Devices without ip are resolved by discovery
+    :raises ValueError: Invalid fleet file
+    :return: The list of devices
+    """
+    with open(path, encoding='utf-8') as file:
+        devices = json.load(file)
+    if not isinstance(devices, list):
+        raise ValueError('Fleet file must contain a list of devices')
+    ids = set()
+    for device in devices:
+        if 'ip' not in device and 'uid' not in device:
+            raise ValueError(f"Device without ip and uid in fleet file: {device}")
+        if 'ip' not in device and not discovery:
+            raise ValueError(
+                f"Device without ip in fleet file, SC23DCI_DISCOVERY_CIDR is not set: {device}"
+            )
+        device.setdefault('id', re.sub(r'[^A-Za-z0-9_-]', '_', device.get('uid') or device['ip']))
+        if device['id'] in ids:
+            raise ValueError(f"Duplicate device id in fleet file: {device['id']}")
+        ids.add(device['id'])
+    return devices
+
+
+def devices_from_discovery(discovered: dict[str, dict]) -> list[dict]:
+    """
+    Builds the fleet of all discovered devices
+    :param discovered: The discovered devices by UID
+    :return: The list of devices
+    """
+    return [
+        {'ip': device['ip'], 'uid': uid, 'id': re.sub(r'[^A-Za-z0-9_-]', '_', uid)}
+        for uid, device in sorted(discovered.items())
+    ]
+
+
+def resolve_ips(devices: list[dict], discovery: Discovery) -> list[dict]:
+    """
+    Sets the discovered ip of the devices with UID.
+    Scans the range if a device has neither an ip nor a discovered UID.
+    :param devices: The devices of the fleet
+    :param discovery: The discovery of the devices
+    :return: The devices with the discovered ips
+    """
+    if any('ip' not in device and discovery.lookup(device['uid']) is None for device in devices):
+        discovery.scan()
+    resolved = []
+    for device in devices:
+        ip = discovery.lookup(device['uid']) if 'uid' in device else None
+        resolved.append(device if ip is None or ip == device.get('ip') else {**device, 'ip': ip})
+    return resolved
+
+
+def request_resolve(resolve_requests: Queue, uid: str) -> None:
+    """
+    Resolver of the workers of a supervisor.
+    Only the supervisor scans, it restarts the worker with the new ip of the device.
+    :param resolve_requests: The queue of UIDs to resolve
+    :param uid: The UID of the device
+    :return: None, the ip is not known yet
+    """
+    resolve_requests.put(uid)
+
+
+def device_key(device: dict) -> str:
+    """
+    The key used to shard a device
+    :param device: The device of the fleet file
+    :return: The UID, the serial or the ip of the device
+    """
+    return device.get('uid') or device.get('serial') or device['ip']
+
+
+def stable_hash(key: str) -> int:
+    """
+    Hash that is equal across processes and restarts, unlike hash()
+    :param key: The key to hash
+    :return: The hash
+    """
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:  # pylint: disable=too-few-public-methods
+    """
+    Consistent hash ring. Adding or removing a device only moves that device,
+    changing the number of workers moves about 1/workers of the devices.
+    """
+
+    def __init__(self, workers: int, replicas: int = 128):
+        """
+        :param workers: The number of workers
+        :param replicas: The number of points per worker on the ring
+        """
+        self.ring = sorted(
+            (stable_hash(f"worker-{worker}-{replica}"), worker)
+            for worker in range(workers)
+            for replica in range(replicas)
+        )
+        self.points = [point for point, _ in self.ring]
+
+    def worker_for(self, key: str) -> int:
+        """
+        Looks up the worker of a key
+        :param key: The key of the device
+        :return: The index of the worker
+        """
+        index = bisect.bisect(self.points, stable_hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+def worker_lwt_topic(index: int) -> str:
+    """
+    The LWT topic of a worker
+    :param index: The index of the worker
+    :return: The topic. eg.: sc23dci/lwt/worker-0
+    """
+    return f"{Env.get_env('MQTT_TOPIC_LWT')}/worker-{index}"
+
+
+def run_worker(
+        index: int,
+        devices: list[dict],
+        resolver: Callable[[str], str | None] | None = None,
+        reports: Queue | None = None
+):
+    """
+    Polls and publishes a shard of the fleet in this process using one MQTT connection
+    :param index: The index of the worker
+    :param devices: The devices of the shard
+    :param resolver: Looks up the ip of a UID when polls keep failing. eg.: Discovery.resolve
+    :param reports: The queue the broadcast reports are sent to the supervisor,
+    None publishes them directly
+    """
+    lwt_topic = worker_lwt_topic(index)
+    client = mqtt.Client(client_id=f"sc23dci-worker-{index}")
+    client.will_set(lwt_topic, payload='offline', retain=True)
+    broadcaster = Broadcaster(
+        index,
+        int(Env.get_env('SC23DCI_BROADCAST_PARALLELISM')),
+        reports
+    )
+    profiler = Profiler(f"worker-{index}")
+    profiler.install_signal_handler()
+
+    acs = []
+    for device in devices:
+        logger.info(f"Worker {index}: creating SC23DCI instance {device['id']}")
+        # an unreachable device must not delay the others, the scheduler polls it first
+        ac = SC23DCI(device.get('ip'), device_id=device['id'], poll=False)
+        if resolver is not None:
+            ac.set_resolver(resolver, device.get('uid'))
+        ac.use_mqtt_client(client, lwt_topic)
+        ac.mqtt_enable_publish_temperature(ac.topic('MQTT_TOPIC_TEMPERATURE'))
+        ac.mqtt_enable_publish_power_state(ac.topic('MQTT_TOPIC_POWERSTATE'))
+        ac.mqtt_enable_publish_all(ac.topic('MQTT_TOPIC_ALL'))
+        ac.mqtt_enable_publish_usage(ac.topic('MQTT_TOPIC_USAGE'))
+        if Env.get_env('MQTT_TOPIC_ALL_COMPACT'):
+            ac.mqtt_enable_publish_all_compact(ac.topic('MQTT_TOPIC_ALL_COMPACT'))
+        broadcaster.add_device(ac, device.get('tags', []))
+        acs.append(ac)
+
+    def home_assistant_autodiscover_wrapper(client, userdata, msg):  # pylint: disable=unused-argument
+        if msg.payload == b'online':
+            for ac in acs:
+                ac.mqtt_home_assistant_autodiscover()
+
+    def on_connect(client, userdata, flags, rc):
+        client.publish(lwt_topic, payload='online', retain=True)
+        for ac in acs:
+            ac.mqtt_on_connect(client, userdata, flags, rc)
+        # every device registered its own callback, one callback has to serve all of them
+        client.message_callback_add('homeassistant/status', home_assistant_autodiscover_wrapper)
+        broadcaster.subscribe(client)
+        client.subscribe(Env.get_env('MQTT_TOPIC_PROFILE_SET'))
+        client.message_callback_add(Env.get_env('MQTT_TOPIC_PROFILE_SET'), profiler.on_mqtt_profile)
+
+    client.on_connect = on_connect
+    client.connect(Env.get_env('MQTT_BROKER_IP'), int(Env.get_env('MQTT_BROKER_PORT')))
+    client.loop_start()
+
+    # every device polls at a random phase of its interval
+    scheduler = Scheduler(int(Env.get_env('SC23DCI_SCHEDULER_WORKERS')))
+    scheduler.install_signal_handler()
+    for device, ac in zip(devices, acs):
+        scheduler.add_job(
+            device['id'],
+            ac.refresh,
+            float(device.get('poll_interval', Env.get_env('SC23DCI_POLL_INTERVAL')))
+        )
+    logger.info(f"Worker {index}: running {len(acs)} devices")
+    scheduler.start()
+    # worker processes exit without atexit handlers
+    for ac in acs:
+        ac.usage.save()
+    logger.info(f"Worker {index}: stopped")
+
+
+def run_worker_process(
+        index: int,
+        devices: list[dict],
+        resolve_requests: Queue | None,
+        reports: Queue
+):
+    """
+    Entry point of a worker process, drops the signal handlers of the supervisor.
+    The worker stops on SIGTERM once its devices are running.
+    :param index: The index of the worker
+    :param devices: The devices of the shard
+    :param resolve_requests: The queue the UIDs of failing devices are sent to the supervisor,
+    None without discovery
+    :param reports: The queue the broadcast reports are sent to the supervisor
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    resolver = None
+    if resolve_requests is not None:
+        resolver = functools.partial(request_resolve, resolve_requests)
+    run_worker(index, devices, resolver, reports)
+
+
+# pylint: disable=too-many-instance-attributes
+class Supervisor:
+    """
+    Shards the fleet across worker processes by consistent hashing of the device UID.
+    Restarts crashed workers and rebalances when the fleet file
+    or, without fleet file, the discovered devices change.
+    The supervisor owns the discovery. Workers request a scan when a device keeps failing
+    and are restarted when the ip of one of their devices changed.
+    """
+    check_interval: float = 5
+    max_restart_delay: float = 60
+
+    def __init__(self, path: str, workers: int, discovery: Discovery | None = None):
+        """
+        :param path: The path of the fleet file, empty to run all discovered devices
+        :param workers: The number of worker processes
+        :param discovery: The discovery of the devices
+        """
+        self.path = path
+        self.discovery = discovery
+        self.workers = workers
+        self.ring = HashRing(workers)
+        self.context = multiprocessing.get_context('fork')
+        self.processes: dict[int, BaseProcess] = {}
+        self.shards: dict[int, list[dict]] = {index: [] for index in range(workers)}
+        self.started: dict[int, float] = {}
+        self.failures: dict[int, int] = {index: 0 for index in range(workers)}
+        self.restart_at: dict[int, float] = {}
+        self.fleet_mtime = 0.0
+        self.fleet: list[dict] = []
+        self.resolve_requests: Queue | None = None
+        if discovery is not None:
+            self.resolve_requests = self.context.Queue()
+        self.reports = self.context.Queue()
+        self.aggregator = ReportAggregator()
+        self.running = True
+
+    def assign(self, devices: list[dict]) -> dict[int, list[dict]]:
+        """
+        Assigns the devices to the workers
+        :param devices: The devices of the fleet
+        :return: The devices of each worker
+        """
+        shards: dict[int, list[dict]] = {index: [] for index in range(self.workers)}
+        for device in devices:
+            shards[self.ring.worker_for(device_key(device))].append(device)
+        return shards
+
+    def start_worker(self, index: int):
+        """
+        Starts the process of a worker, workers without devices are not started
+        :param index: The index of the worker
+        """
+        if not self.shards[index]:
+            return
+        process = self.context.Process(
+            target=run_worker_process,
+            args=(index, self.shards[index], self.resolve_requests, self.reports),
+            name=f"sc23dci-worker-{index}"
+        )
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+        logger.info(f"Started worker {index} with {len(self.shards[index])} devices")
+
+    def stop_worker(self, index: int):
+        """
+        Stops the process of a worker
+        :param index: The index of the worker
+        """
+        process = self.processes.pop(index, None)
+        if process is None:
+            return
+        process.terminate()
+        process.join(10)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        logger.info(f"Stopped worker {index}")
+
+    def handle_resolve_requests(self):
+        """
+        Scans once for all devices the workers could not reach, scans are throttled by discovery
+        """
+        if self.resolve_requests is None or self.discovery is None:
+            return
+        uids = set()
+        while not self.resolve_requests.empty():
+            uids.add(self.resolve_requests.get_nowait())
+        if uids:
+            logger.debug(f"Resolving {len(uids)} unreachable devices")
+            self.discovery.scan()
+
+    def load_devices(self) -> list[dict] | None:
+        """
+        Reads the fleet file if it changed or scans for devices without fleet file.
+        Devices with a discovered UID get their discovered ip.
+        :return: The devices of the fleet or None if the fleet file could not be loaded
+        """
+        self.handle_resolve_requests()
+        if not self.path and self.discovery is not None:
+            return devices_from_discovery(self.discovery.scan())
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime != self.fleet_mtime:
+                self.fleet = load_fleet(self.path, self.discovery is not None)
+                self.fleet_mtime = mtime
+        except (OSError, ValueError) as e:
+            logger.error(f"Fleet file {self.path} not loaded: {e}")
+            return None
+        if self.discovery is None:
+            return self.fleet
+        return resolve_ips(self.fleet, self.discovery)
+
+    def reload(self):
+        """
+        Restarts the workers whose devices changed
+        """
+        devices = self.load_devices()
+        if devices is None:
+            return
+        shards = self.assign(devices)
+        if shards == self.shards:
+            return
+        for index in range(self.workers):
+            if shards[index] != self.shards[index]:
+                self.stop_worker(index)
+                self.restart_at.pop(index, None)
+                self.shards[index] = shards[index]
+                self.failures[index] = 0
+                self.start_worker(index)
+        logger.info(f"Fleet of {len(devices)} devices on {self.workers} workers")
+
+    def check_workers(self):
+        """
+        Restarts crashed workers with an exponential backoff
+        """
+        now = time.monotonic()
+        for index, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            del self.processes[index]
+            if now - self.started[index] > self.max_restart_delay:
+                self.failures[index] = 0
+            delay = min(2 ** self.failures[index], self.max_restart_delay)
+            self.failures[index] += 1
+            self.restart_at[index] = now + delay
+            logger.error(
+                f"Worker {index} exited with code {process.exitcode}, restarting in {delay}s"
+            )
+        for index, restart_at in list(self.restart_at.items()):
+            if restart_at <= now:
+                del self.restart_at[index]
+                self.start_worker(index)
+
+    def collect_reports(self, duration: float):
+        """
+        Merges and publishes the broadcast reports of the workers for a while
+        :param duration: The time in seconds to collect
+        """
+        until = time.monotonic() + duration
+        while (remaining := until - time.monotonic()) > 0:
+            try:
+                key, report = self.reports.get(timeout=remaining)
+            except queue.Empty:
+                break
+            merged = self.aggregator.add(key, report, len(self.processes))
+            if merged is not None:
+                publish_report(merged)
+        for merged in self.aggregator.expired():
+            publish_report(merged)
+
+    def forward_signal(self, signum, frame):  # pylint: disable=unused-argument
+        """
+        Forwards a signal to all workers. eg.: SIGUSR1 to toggle their profilers
+        """
+        for process in self.processes.values():
+            if process.pid is not None:
+                os.kill(process.pid, signum)
+
+    def stop(self, signum=None, frame=None):  # pylint: disable=unused-argument
+        """
+        Stops the supervisor and all workers
+        """
+        self.running = False
+
+    def run(self):
+        """
+        Supervises the workers until SIGTERM or SIGINT
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, self.forward_signal)
+        while self.running:
+            self.reload()
+            self.check_workers()
+            self.collect_reports(self.check_interval)
+        for index in list(self.processes):
+            self.stop_worker(index)
+
+
+def run_fleet(path: str, workers: int):
+    """
+    Runs the fleet in this process or, with more than one worker, supervised in worker processes
+    :param path: The path of the fleet file, empty to run all discovered devices
+    :param workers: The number of worker processes
+    """
+    group_level()
+    discovery = discovery_from_env()
+    if workers <= 1:
+        if discovery is None:
+            run_worker(0, load_fleet(path))
+        elif path:
+            run_worker(0, resolve_ips(load_fleet(path, True), discovery), discovery.resolve)
+        else:
+            run_worker(0, devices_from_discovery(discovery.scan()), discovery.resolve)
+        return
+    Supervisor(path, workers, discovery).run()
@@ -0,0 +1,66 @@
+"""
+Log Sampler Module
+Limits repeated log messages, so an offline device does not flood the log file
+"""
+import threading
+import time
+
+
+class LogSampler:
+    """
+    Logs the first message of a kind and drops its repetitions for an interval.
+    The number of dropped repetitions is added to the next logged message of the kind.
+    """
+
+    def __init__(self, interval: float):
+        """
+        :param interval: The minimum time in seconds between two messages of a kind,
+        0 logs every message
+        """
+        self.interval = interval
+        self.last: dict[str, float] = {}
+        self.suppressed: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def allow(self, key: str) -> int | None:
+        """
+        Checks if a message of the kind may be logged now
+        :param key: The kind of the message. eg.: GET status
+        :return: The number of dropped repetitions since the last message or None to drop it
+        """
+        if self.interval <= 0:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last.get(key, float('-inf')) < self.interval:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return None
+            self.last[key] = now
+            return self.suppressed.pop(key, 0)
+
+    def reset(self, key: str):
+        """
+        Logs the next message of the kind again. eg.: when the device recovered
+        :param key: The kind of the message
+        """
+        with self.lock:
+            self.last.pop(key, None)
+            self.suppressed.pop(key, None)
+
+    def log(self, log, level: str, key: str, message: str, exception=None, **fields):
+        """
+        Logs a message unless it is a repetition within the interval.
+        The message is formatted by loguru with the fields, only if the level is enabled.
+        :param log: The logger, usually bound to the device
+        :param level: The level. eg.: ERROR
+        :param key: The kind of the message
+        :param message: The message with {field} placeholders
+        :param exception: An exception whose traceback is logged with the message
+        :param fields: The structured fields. eg.: endpoint, attempt, latency
+        """
+        suppressed = self.allow(key)
+        if suppressed is None:
+            return
+        if suppressed:
+            message += ' ({suppressed} repetitions suppressed)'
+        log.opt(depth=1, exception=exception).log(level, message, suppressed=suppressed, **fields)
@@ -0,0 +1,248 @@
+"""
+Profiler Module
+On-demand sampling profiler and tracemalloc snapshots, controlled over MQTT or SIGUSR1
+"""
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+from loguru import logger
+
+from env.env import Env
+
+# top frames of threads that are waiting, they are not counted as hot
+IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('selectors.py', 'select'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+    ('client.py', '_loop')
+}
+
+
+def frame_key(frame) -> tuple[str, int, str]:
+    """
+    Identifies the function of a frame
+    :param frame: The frame
+    :return: The filename, the first line and the name of the function
+    """
+    code = frame.f_code
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+# pylint: disable=too-many-instance-attributes
+class Profiler:
+    """
+    Samples the stacks of all threads for a bounded duration.
+    cProfile only sees the thread that enables it, but refresh, mqtt_publish and the HTTP calls
+    run on the scheduler, MQTT and broadcast threads, so the stacks of all threads are sampled.
+    Optionally tracemalloc reports the allocation sites that grew during the run.
+    """
+    interval: float = 0.005
+
+    def __init__(self, label: str = 'agent'):
+        """
+        :param label: Distinguishes the reports of several processes. eg.: worker-0
+        """
+        self.label = label
+        self.directory = Env.get_env('SC23DCI_PROFILE_DIR')
+        self.default_duration = float(Env.get_env('SC23DCI_PROFILE_DURATION'))
+        self.max_duration = float(Env.get_env('SC23DCI_PROFILE_MAX_DURATION'))
+        self.stop_event = threading.Event()
+        self.thread: threading.Thread | None = None
+        self.self_samples: Counter = Counter()
+        self.total_samples: Counter = Counter()
+        self.samples = 0
+
+    def running(self) -> bool:
+        """
+        :return: True while a profile is recorded
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration: float | None = None, top: int = 20, trace_malloc: bool = True):
+        """
+        Starts recording a profile in the background
+        :param duration: The duration in seconds, bounded by SC23DCI_PROFILE_MAX_DURATION
+        :param top: The number of functions and allocation sites in the report
+        :param trace_malloc: Also report the allocation sites
+        """
+        if self.running():
+            logger.warning('Profiler is already running')
+            return
+        duration = min(duration or self.default_duration, self.max_duration)
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run,
+            args=(duration, top, trace_malloc),
+            name='sc23dci-profiler',
+            daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the recording early, the report is still written
+        """
+        self.stop_event.set()
+
+    def toggle(self):
+        """
+        Starts a profile with the default duration or stops the running one
+        """
+        if self.running():
+            self.stop()
+        else:
+            self.start()
+
+    def sample(self):
+        """
+        Counts the functions on the stacks of all other threads
+        """
+        own_id = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if thread_id == own_id:
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+            self.samples += 1
+            self.self_samples[frame_key(frame)] += 1
+            seen = set()
+            while frame is not None:
+                key = frame_key(frame)
+                if key not in seen:
+                    seen.add(key)
+                    self.total_samples[key] += 1
+                frame = frame.f_back
+
+    def run(self, duration: float, top: int, trace_malloc: bool):
+        """
+        Records the profile and writes the report
+        :param duration: The duration in seconds
+        :param top: The number of functions and allocation sites in the report
+        :param trace_malloc: Also report the allocation sites
+        """
+        logger.info(f"Profiling {self.label} for {duration}s")
+        self.self_samples.clear()
+        self.total_samples.clear()
+        self.samples = 0
+        started_tracemalloc = trace_malloc and not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start()
+        first_snapshot = tracemalloc.take_snapshot() if trace_malloc else None
+        start = time.monotonic()
+        while not self.stop_event.wait(self.interval):
+            if time.monotonic() - start >= duration:
+                break
+            self.sample()
+        elapsed = time.monotonic() - start
+        lines = self.report_functions(elapsed, top)
+        if first_snapshot is not None:
+            lines += self.report_allocations(first_snapshot, top)
+        if started_tracemalloc:
+            tracemalloc.stop()
+        self.write_report(lines)
+
+    def report_functions(self, elapsed: float, top: int) -> list[str]:
+        """
+        Summarizes the hot functions
+        :param elapsed: The duration of the profile in seconds
+        :param top: The number of functions
+        :return: The lines of the report
+        """
+        lines = [
+            f"SC23DCI profile {self.label}, {elapsed:.1f}s, {self.samples} samples "
+            f"of busy threads every {self.interval * 1000:.0f}ms",
+            '',
+            f"Top {top} functions by own samples:"
+        ]
+        samples = max(self.samples, 1)
+        for (filename, line, name), count in self.self_samples.most_common(top):
+            lines.append(f"{count:8d} {count / samples:6.1%}  {name} {filename}:{line}")
+        lines += ['', f"Top {top} functions by samples including callees:"]
+        for (filename, line, name), count in self.total_samples.most_common(top):
+            lines.append(f"{count:8d} {count / samples:6.1%}  {name} {filename}:{line}")
+        return lines
+
+    @staticmethod
+    def report_allocations(first_snapshot: tracemalloc.Snapshot, top: int) -> list[str]:
+        """
+        Summarizes the allocation sites that grew during the profile
+        :param first_snapshot: The snapshot taken at the start
+        :param top: The number of allocation sites
+        :return: The lines of the report
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            '',
+            f"Traced memory: {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB",
+            f"Top {top} allocation sites by growth:"
+        ]
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__)
+        ])
+        for stat in snapshot.compare_to(first_snapshot, 'lineno')[:top]:
+            lines.append(str(stat))
+        return lines
+
+    def write_report(self, lines: list[str]):
+        """
+        Writes the report next to the log file and logs the top entries
+        :param lines: The lines of the report
+        """
+        path = os.path.join(
+            self.directory,
+            f"sc23dci-profile-{self.label}-{datetime.now():%Y%m%d-%H%M%S}.txt"
+        )
+        try:
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write('\n'.join(lines) + '\n')
+        except OSError as e:
+            logger.error(f"Profile not written to {path}: {e}")
+            path = 'log only'
+        logger.info(f"Profile written to {path}\n" + '\n'.join(lines[:8]))
+
+    def on_mqtt_profile(self, client, userdata, msg):  # pylint: disable=unused-argument
+        """
+        The callback of the profile control topic.
+        The payload is off, the duration in seconds
+        or a JSON object with duration, top and tracemalloc. eg.: {"duration": 60, "top": 10}
+        :param client: The MQTT client
+        :param userdata:
+        :param msg: The message with payload
+        """
+        payload = msg.payload.decode('utf-8').strip()
+        if payload in ['off', '0', 'stop']:
+            self.stop()
+            return
+        try:
+            options = json.loads(payload) if payload else {}
+            if not isinstance(options, dict):
+                options = {'duration': float(options)}
+            self.start(
+                float(options.get('duration', self.default_duration)),
+                int(options.get('top', 20)),
+                bool(options.get('tracemalloc', True))
+            )
+        except (ValueError, TypeError) as e:
+            logger.error(f"Invalid profile request {payload}: {e}")
+
+    def on_signal(self, signum, frame):  # pylint: disable=unused-argument
+        """
+        The SIGUSR1 handler, toggles the profiler
+        """
+        self.toggle()
+
+    def install_signal_handler(self):
+        """
+        Toggles the profiler on SIGUSR1, has to be called from the main thread
+        """
+        signal.signal(signal.SIGUSR1, self.on_signal)
@@ -0,0 +1,111 @@
+"""
+Rate Limiter Module
+Protects a single SC23DCI device from being flooded with requests
+"""
+import threading
+import time
+from enum import IntEnum
+
+
+class Priority(IntEnum):
+    """
+    Priority classes of device bound requests, lower values are more important
+    """
+    COMMAND = 1
+    CONFIRMATION = 2
+    POLL = 3
+    SCAN = 4
+
+
+# pylint: disable=too-many-instance-attributes
+class RateLimiter:
+    """
+    Token bucket rate limiter with priority classes.
+    Every request takes one token. Lower priorities have to leave a reserve
+    of tokens in the bucket and give up earlier, so user commands still find
+    headroom while polling or scanning is heavy.
+    A rate of 0 or less disables the limiter.
+    Dropped requests are counted in dropped, logging them is left to the caller.
+    """
+
+    # share of the bucket that has to stay untouched by a priority class
+    reserve_share: dict[Priority, float] = {
+        Priority.COMMAND: 0.0,
+        Priority.CONFIRMATION: 0.25,
+        Priority.POLL: 0.5,
+        Priority.SCAN: 0.75
+    }
+
+    # share of max_wait a priority class waits for a token before it is dropped
+    wait_share: dict[Priority, float] = {
+        Priority.COMMAND: 1.0,
+        Priority.CONFIRMATION: 0.5,
+        Priority.POLL: 0.0,
+        Priority.SCAN: 0.0
+    }
+
+    def __init__(self, rate: float, burst: int, max_wait: float = 5.0):
+        """
+        :param rate: The number of tokens refilled per second
+        :param burst: The size of the bucket
+        :param max_wait: The maximum time in seconds a request waits for a token
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_wait = max_wait
+        self.tokens = float(self.burst)
+        self.last_refill = time.monotonic()
+        self.waiting: dict[Priority, int] = {priority: 0 for priority in Priority}
+        self.dropped: dict[Priority, int] = {priority: 0 for priority in Priority}
+        self.condition = threading.Condition()
+
+    def __repr__(self):
+        return (
+            f"(Rate: {self.rate}/s, Burst: {self.burst}, Tokens: {self.tokens:.2f}, "
+            f"Dropped: {[self.dropped[priority] for priority in Priority]})"
+        )
+
+    def refill(self):
+        """
+        Adds the tokens earned since the last refill
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def available(self, priority: Priority) -> bool:
+        """
+        Checks if a request of the given priority may take a token now
+        :param priority: The priority of the request
+        :return: True if a token can be taken
+        """
+        for higher in Priority:
+            if higher < priority and self.waiting[higher] > 0:
+                return False
+        return self.tokens >= 1 + self.burst * self.reserve_share[priority]
+
+    def acquire(self, priority: Priority) -> bool:
+        """
+        Takes a token for a request. Blocks up to the wait time of the priority class.
+        :param priority: The priority of the request
+        :return: True if the request may be sent, False if it has to be dropped
+        """
+        if self.rate <= 0:
+            return True
+        deadline = time.monotonic() + self.max_wait * self.wait_share[priority]
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    self.refill()
+                    if self.available(priority):
+                        self.tokens -= 1
+                        return True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.dropped[priority] += 1
+                        return False
+                    self.condition.wait(min(remaining, 1 / self.rate))
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
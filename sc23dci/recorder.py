@@ -0,0 +1,158 @@
+"""
+Recorder Module
+Captures the HTTP and MQTT traffic of a SC23DCI agent to a file
+"""
+import atexit
+import gzip
+import json
+import threading
+import time
+from typing import IO, Any
+
+from loguru import logger
+
+API_PATH = '/api/v/1/'
+
+
+def open_trace(path: str, mode: str) -> IO[str]:
+    """
+    Opens a trace file, files ending with .gz are gzip compressed
+    :param path: The path of the trace file
+    :param mode: r or w
+    :return: The opened text file
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt' if mode == 'w' else 'rt', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')  # pylint: disable=consider-using-with
+
+
+class Recorder:
+    """
+    Writes captured traffic as JSON lines.
+    Plain traces are flushed after every line. Every flush of a gzip stream ends a compression
+    block, so compressed traces are flushed every flush_interval seconds and on close.
+    Every line holds the time since the start of the recording in t and the kind of event in k.
+    - http: m: method, e: endpoint, d: request data, s: status code or None on errors, b: body
+    - mqtt: topic: the topic, p: payload
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The path of the trace file, use .gz for a compressed trace
+        """
+        self.path = path
+        self.file = open_trace(path, 'w')
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.flush_interval = 5.0 if path.endswith('.gz') else 0.0
+        self.last_flush = self.start
+        atexit.register(self.close)
+        logger.info(f"Recording traffic to {path}")
+
+    def write(self, event: dict):
+        """
+        Appends an event to the trace file
+        :param event: The event without the timestamp
+        """
+        event['t'] = round(time.monotonic() - self.start, 3)
+        line = json.dumps(event, separators=(',', ':'))
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(line + '\n')
+            if time.monotonic() - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = time.monotonic()
+
+    def record_http(self, method: str, url: str, data, res):
+        """
+        Records an HTTP exchange
+        :param method: GET or POST
+        :param url: The requested url
+        :param data: The request body
+        :param res: The response or None if the request failed
+        """
+        self.write({
+            'k': 'http',
+            'm': method,
+            'e': url.split(API_PATH, 1)[-1],
+            'd': data,
+            's': None if res is None else res.status_code,
+            'b': None if res is None else res.content.decode('utf-8', 'replace')
+        })
+
+    def record_mqtt(self, msg):
+        """
+        Records an incoming MQTT message
+        :param msg: The message with topic and payload
+        """
+        self.write({
+            'k': 'mqtt',
+            'topic': msg.topic,
+            'p': msg.payload.decode('utf-8', 'replace')
+        })
+
+    def wrap_http_client(self, client: Any):
+        """
+        Wraps an HTTP client so all requests are recorded
+        :param client: Anything providing get and post like requests
+        :return: The recording client
+        """
+        return RecordingClient(client, self)
+
+    def wrap_mqtt_callback(self, cb):
+        """
+        Wraps an MQTT callback so all messages are recorded before they are handled
+        :param cb: The callback function -> (client, userdata, msg)
+        :return: The recording callback
+        """
+        def recording_callback(client, userdata, msg):
+            self.record_mqtt(msg)
+            cb(client, userdata, msg)
+        return recording_callback
+
+    def close(self):
+        """
+        Closes the trace file
+        """
+        with self.lock:
+            self.file.close()
+
+
+class RecordingClient:
+    """
+    HTTP client that records every exchange of the wrapped client
+    """
+
+    def __init__(self, client: Any, recorder: Recorder):
+        self.client = client
+        self.recorder = recorder
+
+    def get(self, url: str, **kwargs):
+        """
+        Sends and records a GET request
+        :param url: The requested url
+        :return: The response
+        """
+        try:
+            res = self.client.get(url, **kwargs)
+        except Exception:
+            self.recorder.record_http('GET', url, None, None)
+            raise
+        self.recorder.record_http('GET', url, None, res)
+        return res
+
+    def post(self, url: str, data=None, **kwargs):
+        """
+        Sends and records a POST request
+        :param url: The requested url
+        :param data: The request body
+        :return: The response
+        """
+        try:
+            res = self.client.post(url, data=data, **kwargs)
+        except Exception:
+            self.recorder.record_http('POST', url, data, None)
+            raise
+        self.recorder.record_http('POST', url, data, res)
+        return res
@@ -0,0 +1,224 @@
+"""
+Replay Module
+Feeds traffic captured by the Recorder back into a SC23DCI instance without network I/O.
+Usage: python -m sc23dci.replay <trace> [--speed <factor>]
+"""
+import argparse
+import json
+import time
+from collections import deque
+from typing import Any
+
+import requests as req
+from loguru import logger
+from paho.mqtt.client import MQTTMessage, topic_matches_sub
+
+from env.env import Env
+from sc23dci.rate_limiter import RateLimiter
+from sc23dci.recorder import API_PATH, open_trace
+from sc23dci.sc23dci import SC23DCI
+from sc23dci.usage import Usage
+
+
+class ReplayResponse:  # pylint: disable=too-few-public-methods
+    """
+    Minimal stand-in for requests.Response
+    """
+
+    def __init__(self, status_code: int, body: str):
+        self.status_code = status_code
+        self.content = body.encode('utf-8')
+
+    def json(self) -> Any:
+        """
+        :return: The decoded body
+        """
+        return json.loads(self.content)
+
+
+class ReplayClient:
+    """
+    HTTP client answering requests with recorded responses in recorded order.
+    Unrecorded POSTs succeed, unrecorded GETs repeat the last response of the endpoint.
+    """
+
+    def __init__(self, events: list[dict]):
+        self.responses: dict[tuple[str, str], deque[dict]] = {}
+        self.last: dict[tuple[str, str], dict] = {}
+        for event in events:
+            if event['k'] == 'http':
+                self.responses.setdefault((event['m'], event['e']), deque()).append(event)
+
+    def respond(self, method: str, url: str):
+        """
+        Looks up the next recorded response
+        :param method: GET or POST
+        :param url: The requested url
+        :raises requests.ConnectionError: The recorded request failed
+        :return: The response
+        """
+        key = (method, url.split(API_PATH, 1)[-1])
+        queue = self.responses.get(key)
+        if queue:
+            self.last[key] = queue.popleft()
+        event = self.last.get(key)
+        if event is None:
+            if method == 'POST':
+                return ReplayResponse(200, '{"success": true}')
+            raise req.ConnectionError(f"No recorded response for {method} {key[1]}")
+        if event['s'] is None:
+            raise req.ConnectionError(f"Recorded failure of {method} {key[1]}")
+        return ReplayResponse(event['s'], event['b'])
+
+    def get(self, url: str, **kwargs):  # pylint: disable=unused-argument
+        """
+        :param url: The requested url
+        :return: The recorded response
+        """
+        return self.respond('GET', url)
+
+    def post(self, url: str, **kwargs):  # pylint: disable=unused-argument
+        """
+        :param url: The requested url
+        :return: The recorded response
+        """
+        return self.respond('POST', url)
+
+
+class ReplayMqttClient:
+    """
+    MQTT client collecting subscriptions and publishes instead of talking to a broker
+    """
+
+    def __init__(self):
+        self.callbacks: dict[str, Any] = {}
+        self.published: list[tuple[str, Any]] = []
+
+    def subscribe(self, topic: str):
+        """
+        :param topic: The topic to subscribe to
+        """
+        self.callbacks.setdefault(topic, None)
+
+    def message_callback_add(self, topic: str, cb):
+        """
+        :param topic: The topic of the callback
+        :param cb: The callback function -> (client, userdata, msg)
+        """
+        self.callbacks[topic] = cb
+
+    def publish(self, topic: str, payload=None, retain: bool = False):  # pylint: disable=unused-argument
+        """
+        :param topic: The topic to publish on
+        :param payload: The payload
+        :param retain: Ignored
+        """
+        self.published.append((topic, payload))
+
+    def deliver(self, topic: str, payload: str):
+        """
+        Hands a message to all matching callbacks
+        :param topic: The topic of the message
+        :param payload: The payload of the message
+        """
+        msg = MQTTMessage(topic=topic.encode('utf-8'))
+        msg.payload = payload.encode('utf-8')
+        for sub, cb in self.callbacks.items():
+            if cb is not None and topic_matches_sub(sub, topic):
+                cb(self, None, msg)
+
+
+class Replayer:
+    """
+    Replays a recorded trace against a SC23DCI instance.
+    Every recorded status poll triggers a refresh, every recorded MQTT message is delivered.
+    POSTs are answered when the instance sends them.
+    The usage aggregates are kept in memory and accounted in the time of the trace.
+    """
+
+    def __init__(self, path: str, speed: float = 0):
+        """
+        :param path: The path of the trace file
+        :param speed: The replay speed relative to the recording, 0 replays as fast as possible
+        """
+        self.events = []
+        with open_trace(path, 'r') as file:
+            try:
+                for line in file:
+                    # the last line of a trace that was not closed may be cut off
+                    if not line.endswith('\n'):
+                        break
+                    if line.strip():
+                        self.events.append(json.loads(line))
+            except EOFError:
+                logger.warning(f"Trace {path} was not closed, replaying the flushed events")
+        self.speed = speed
+        self.mqtt_client = ReplayMqttClient()
+        self.device: SC23DCI | None = None
+
+    def wait(self, start: float, event: dict):
+        """
+        Sleeps until the event is due at the replay speed
+        :param start: The monotonic start time of the replay
+        :param event: The next event
+        """
+        if self.speed <= 0:
+            return
+        delay = start + event['t'] / self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def run(self) -> SC23DCI:
+        """
+        Replays the trace
+        :return: The SC23DCI instance after the replay
+        """
+        # the aggregates of the replay must not touch the persisted ones of the live device
+        device = SC23DCI(
+            'replay',
+            http_client=ReplayClient(self.events),
+            poll=False,
+            usage=Usage('', float(Env.get_env('SC23DCI_USAGE_MAX_GAP')))
+        )
+        device.rate_limiter = RateLimiter(0, 1)
+        device.mqtt_client = self.mqtt_client  # type: ignore
+        device.mqtt_enable_publish_temperature(device.topic('MQTT_TOPIC_TEMPERATURE'))
+        device.mqtt_enable_publish_power_state(device.topic('MQTT_TOPIC_POWERSTATE'))
+        device.mqtt_enable_publish_all(device.topic('MQTT_TOPIC_ALL'))
+        if Env.get_env('MQTT_TOPIC_ALL_COMPACT'):
+            device.mqtt_enable_publish_all_compact(device.topic('MQTT_TOPIC_ALL_COMPACT'))
+        device.mqtt_subscribe_to_all_topics()
+        self.device = device
+
+        start = time.monotonic()
+        for event in self.events:
+            if event['k'] == 'mqtt':
+                self.wait(start, event)
+                self.mqtt_client.deliver(event['topic'], event['p'])
+            elif event['m'] == 'GET' and event['e'] == 'status':
+                self.wait(start, event)
+                device.refresh(event['t'])
+        return device
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays a recorded SC23DCI trace')
+    parser.add_argument('trace', help='the trace file written by SC23DCI_RECORD_FILE')
+    parser.add_argument(
+        '--speed',
+        type=float,
+        default=0,
+        help='replay speed relative to the recording, 0 replays as fast as possible'
+    )
+    args = parser.parse_args()
+
+    replayer = Replayer(args.trace, args.speed)
+    replay_start = time.monotonic()
+    replayed = replayer.run()
+    logger.info(
+        f"Replayed {len(replayer.events)} events in {time.monotonic() - replay_start:.3f}s, "
+        f"{len(replayer.mqtt_client.published)} publishes, "
+        f"{replayed.unchanged_polls} unchanged polls, "
+        f"{replayed.suppressed_writes} suppressed writes, "
+        f"usage {replayed.usage.summary()}"
+    )
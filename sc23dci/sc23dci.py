@@ -2,17 +2,30 @@
 SC23DCI Module
 Used for R/W access to the SC23DCI device and subscribe/publish to mqtt
 """
+# pylint: disable=too-many-lines
+import hashlib
 import json
+import os
+import re
+import threading
 import time
 from datetime import datetime
 from time import sleep
-from typing import Optional
+from typing import Any, Callable, Optional
 
 import paho.mqtt.client as mqtt
 import requests as req
 from loguru import logger
 
 from env.env import Env
+from sc23dci.compact import encode_all
+from sc23dci.log_sampler import LogSampler
+from sc23dci.rate_limiter import Priority, RateLimiter
+from sc23dci.recorder import Recorder
+from sc23dci.usage import Usage
+
+# status fields that change on every poll without a change of the device state
+VOLATILE_STATUS_FIELDS = re.compile(rb'"(uptime|heap|lastRefresh)"\s*:\s*[^,}]*')
 
 
 class ApiError(Exception):
@@ -56,6 +69,7 @@ class SC23DCI:
     """
     mqtt_client: mqtt.Client | None = None
     mqtt_list: list[dict] = []
+    mqtt_subscriptions: list[tuple] = []
     req_base_url: str | None = None
     set_point: str | None = None
     working_mode: str | None = None
@@ -83,16 +97,88 @@ class SC23DCI:
     wifi: list[Wifi] = []
     http_timeout: int = 5
     http_timeout_retry_count: int = 0
+    # anything providing get and post like requests
+    http_client: Any = req
+    recorder: Recorder | None = None
     unknown: list[dict] = []
     change_backlog: list[dict] = []
+    confirmed_state: dict = {}
+    suppressed_writes: int = 0
+    status_fingerprint: bytes | None = None
+    last_full_refresh: float = 0.0
+    full_refresh_interval: float = 300
+    unchanged_polls: int = 0
+    rate_limiter: RateLimiter
+    request_context: threading.local
+    device_id: str | None = None
+    worker_lwt_topic: str | None = None
+    http_failures: int = 0
+    resolver: Callable[[str], str | None] | None = None
+    resolve_after_failures: int = 3
+    log: Any = logger
+    log_sampler: LogSampler
+    usage: Usage
+    usage_publish_interval: float = 300
+    last_usage_publish: float = 0.0
 
-    def __init__(self, ip: str):
-        self.req_base_url = f"http://{ip}/api/v/1/"
-        self.refresh()
+    def __init__(  # pylint: disable=too-many-arguments, too-many-positional-arguments
+            self,
+            ip: str | None,
+            http_client: Any = None,
+            recorder: Recorder | None = None,
+            device_id: str | None = None,
+            poll: bool = True,
+            usage: Usage | None = None
+    ):
+        """
+        :param ip: The ip or hostname of the device, None if it has to be resolved by set_resolver
+        :param http_client: Replaces requests for the API calls. eg.: for replays
+        :param recorder: Records the HTTP and MQTT traffic of this instance
+        :param device_id: The id of the device in a fleet, scopes the MQTT topics of the device
+        :param poll: Polls the device before returning, False leaves the first poll to the caller.
+        eg.: the scheduler of a fleet worker
+        :param usage: The usage aggregates, defaults to the file of the device in SC23DCI_USAGE_DIR
+        """
+        self.req_base_url = f"http://{ip}/api/v/1/" if ip else None
+        self.device_id = device_id
+        # instances of a fleet must not share the class level lists
+        self.mqtt_list = []
+        self.mqtt_subscriptions = []
+        self.wifi = []
+        self.unknown = []
+        self.change_backlog = []
+        self.confirmed_state = {}
+        if http_client is not None:
+            self.http_client = http_client
+        if recorder is not None:
+            self.recorder = recorder
+            self.http_client = recorder.wrap_http_client(self.http_client)
+        self.rate_limiter = RateLimiter(
+            float(Env.get_env('SC23DCI_RATE_LIMIT')),
+            int(Env.get_env('SC23DCI_RATE_BURST')),
+            float(Env.get_env('SC23DCI_RATE_MAX_WAIT'))
+        )
+        self.request_context = threading.local()
+        self.full_refresh_interval = float(Env.get_env('SC23DCI_FULL_REFRESH_INTERVAL'))
+        self.resolve_after_failures = int(Env.get_env('SC23DCI_DISCOVERY_AFTER_FAILURES'))
+        self.log = logger.bind(device=device_id or ip)
+        self.log_sampler = LogSampler(float(Env.get_env('SC23DCI_LOG_SAMPLE_INTERVAL')))
+        if usage is None:
+            usage_dir = Env.get_env('SC23DCI_USAGE_DIR')
+            usage_file = f"sc23dci-usage-{device_id}.json" if device_id else 'sc23dci-usage.json'
+            usage = Usage(
+                os.path.join(usage_dir, usage_file) if usage_dir else '',
+                float(Env.get_env('SC23DCI_USAGE_MAX_GAP'))
+            )
+        self.usage = usage
+        self.usage_publish_interval = float(Env.get_env('SC23DCI_USAGE_PUBLISH_INTERVAL'))
+        self.last_usage_publish = time.monotonic()
+        if poll:
+            self.refresh()
 
     def __repr__(self):
         return (
-            f"SC23DCI\n"
+            f"SC23DCI {self.device_id or ''}\n"
             f"set_point:{self.set_point}\n"
             f"working_mode: {self.working_mode}\n"
             f"power_state: {self.power_state}\n"
@@ -120,76 +206,223 @@ class SC23DCI:
             f"MqttClient: {self.mqtt_client}\n"
             f"MqttList: {self.mqtt_list}\n"
             f"unkown: {self.unknown}\n"
-            f"backlog: {self.change_backlog}"
+            f"backlog: {self.change_backlog}\n"
+            f"suppressed_writes: {self.suppressed_writes}\n"
+            f"unchanged_polls: {self.unchanged_polls}\n"
+            f"rate_limiter: {self.rate_limiter}\n"
+            f"usage: {self.usage}"
         )
 
     # http section
-    def http_get(self, endpoint: str):
+    def write_priority(self) -> Priority:
+        """
+        The priority of writes issued by the current thread.
+        Writes are user commands unless they are replayed from the backlog.
+        :return: The priority for http_post
+        """
+        return getattr(self.request_context, 'priority', Priority.COMMAND)
+
+    def acquire_token(self, priority: Priority) -> bool:
+        """
+        Takes a token of the rate limiter, dropped requests are logged sampled per priority
+        :param priority: The priority class of the request
+        :return: True if the request may be sent, False if it is dropped
+        """
+        if self.rate_limiter.acquire(priority):
+            return True
+        self.log_sampler.log(
+            self.log,
+            'DEBUG',
+            f"rate limit {priority.name}",
+            'Rate limit reached, dropped {priority} request',
+            priority=priority.name
+        )
+        return False
+
+    def http_get(self, endpoint: str, priority: Priority = Priority.POLL, raw: bool = False):
         """
         Getter for SC23DCI API endpoints
         :param endpoint: the endpoint of the API. eg.: status | network/scan
-        :return: the response body as json or none
+        :param priority: the priority class of the request for the rate limiter
+        :param raw: return the undecoded response body
+        :return: the response body as json, as bytes if raw is set, or none
         """
         if self.req_base_url is None:
             return None
+        if not self.acquire_token(priority):
+            return None
         retries = 0
+        error: Exception | None = None
         while retries <= self.http_timeout_retry_count:
+            start = time.monotonic()
             try:
-                res = req.get(self.req_base_url + endpoint, timeout=self.http_timeout)
+                res = self.http_client.get(self.req_base_url + endpoint, timeout=self.http_timeout)
                 if res.status_code != 200:
-                    logger.error(f"GET {endpoint} {res.status_code}")
                     # something went wrong.
                     raise ApiError(f"GET {endpoint} {res.status_code}")
+                self.http_succeeded('GET', endpoint, start, retries)
+                if raw:
+                    return res.content
                 return res.json()
-            except:  # pylint: disable=bare-except
-                logger.debug(f"Timeout on {self.req_base_url}{endpoint}")
-                time.sleep(1)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                error = e
+                self.log.debug(
+                    'GET {endpoint} failed on attempt {attempt} after {latency:.3f}s: {error}',
+                    endpoint=endpoint,
+                    attempt=retries + 1,
+                    latency=time.monotonic() - start,
+                    error=e
+                )
                 retries += 1
-        logger.debug(f"Missed all timeout retries {self.req_base_url}{endpoint}")
+                if retries <= self.http_timeout_retry_count:
+                    time.sleep(1)
+        self.http_failed('GET', endpoint, retries, error)
         return None
 
-    def http_post(self, endpoint, data=None):
+    def http_post(self, endpoint, data=None, priority: Priority | None = None):
         """
         Setter for SC23DCI API endpoints
         :param endpoint: the endpoint of the API. eg.: power/on
         :param data: the request body
+        :param priority: the priority class of the request for the rate limiter,
+        defaults to the write priority of the current thread
         :return: the response body as json or none
         """
+        if not self.acquire_token(priority or self.write_priority()):
+            return None
         retries = 0
+        error: Exception | None = None
         while retries <= self.http_timeout_retry_count:
+            start = time.monotonic()
             try:
                 if data is not None:
-                    res = req.post(
+                    res = self.http_client.post(
                         self.req_base_url + endpoint,
                         data=data,
                         timeout=self.http_timeout
                     )
                 else:
-                    res = req.post(
+                    res = self.http_client.post(
                         self.req_base_url + endpoint,
                         timeout=self.http_timeout
                     )
                 if res.status_code != 200:
-                    logger.error(f"POST {endpoint} {res.status_code}")
                     # This means something went wrong.
                     raise ApiError(f"POST {endpoint} {res.status_code}")
-                # logger.debug("status: {}, response: {}", res.status_code, res.json())
+                self.http_succeeded('POST', endpoint, start, retries)
                 return res.json()
-            except:  # pylint: disable=bare-except
-                logger.debug(
-                    f"Timeout on POST {self.req_base_url}{endpoint}, data: {data}"
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                error = e
+                self.log.debug(
+                    'POST {endpoint} failed on attempt {attempt} after {latency:.3f}s: {error}',
+                    endpoint=endpoint,
+                    attempt=retries + 1,
+                    latency=time.monotonic() - start,
+                    error=e
                 )
                 retries += 1
-        logger.debug(f"Missed all timeout retries {self.req_base_url}{endpoint}, data: {data}")
+        self.http_failed('POST', endpoint, retries, error)
         return None
 
-    def refresh(self):   # pylint: disable=too-many-statements
+    def http_succeeded(self, method: str, endpoint: str, start: float, retries: int):
+        """
+        Resets the failure count and logs the recovery of a failing endpoint
+        :param method: The HTTP method. eg.: GET
+        :param endpoint: The endpoint of the API
+        :param start: The monotonic time the request started
+        :param retries: The number of failed attempts before
+        """
+        if self.http_failures:
+            self.log.info(
+                '{method} {endpoint} recovered after {failures} failed requests',
+                method=method,
+                endpoint=endpoint,
+                failures=self.http_failures
+            )
+            self.log_sampler.reset(f"{method} {endpoint}")
+        self.http_failures = 0
+        self.log.trace(
+            '{method} {endpoint} took {latency:.3f}s',
+            method=method,
+            endpoint=endpoint,
+            attempt=retries + 1,
+            latency=time.monotonic() - start
+        )
+
+    def http_failed(self, method: str, endpoint: str, attempts: int, error: Exception | None):
+        """
+        Counts a request that missed all retries and logs it, sampled per endpoint
+        :param method: The HTTP method. eg.: GET
+        :param endpoint: The endpoint of the API
+        :param attempts: The number of attempts
+        :param error: The error of the last attempt
+        """
+        self.http_failures += 1
+        self.log_sampler.log(
+            self.log,
+            'WARNING',
+            f"{method} {endpoint}",
+            '{method} {endpoint} failed after {attempt} attempts: {error}',
+            method=method,
+            endpoint=endpoint,
+            attempt=attempts,
+            error=error
+        )
+
+    @staticmethod
+    def fingerprint(body: bytes) -> bytes:
+        """
+        Fingerprints the raw status body with volatile fields masked
+        :param body: The raw response body of the status endpoint
+        :return: The fingerprint
         """
-        Polls new data from the device and updates this instance
+        return hashlib.blake2b(VOLATILE_STATUS_FIELDS.sub(b'', body), digest_size=16).digest()
+
+    def is_status_unchanged(self, fingerprint: bytes) -> bool:
         """
+        Compares the fingerprint of the status body to the one of the last full refresh.
+        A full refresh is forced while writes are pending
+        or when the last one is older than full_refresh_interval.
+        :param fingerprint: The fingerprint of the raw response body of the status endpoint
+        :return: True if the device state did not change since the last full refresh
+        """
+        return (
+                fingerprint == self.status_fingerprint
+                and not self.change_backlog
+                and time.monotonic() - self.last_full_refresh < self.full_refresh_interval
+        )
+
+    def refresh(self, now: float | None = None):   # pylint: disable=too-many-statements
+        """
+        Polls new data from the device and updates this instance.
+        Polls without a change of the device state are only counted in unchanged_polls.
+        :param now: The time of the poll for the usage aggregates, defaults to the current time.
+        eg.: the time of the trace in a replay
+        """
+        # a poll with pending writes confirms them
+        priority = Priority.CONFIRMATION if self.change_backlog else Priority.POLL
+        body = self.http_get('status', priority, raw=True)
+        if body is None and (
+                self.req_base_url is None or self.http_failures >= self.resolve_after_failures
+        ):
+            self.resolve()
+        fingerprint = None if body is None else self.fingerprint(body)
+        if fingerprint is not None and self.is_status_unchanged(fingerprint):
+            self.unchanged_polls += 1
+            self.log.trace('Status unchanged, {polls} polls', polls=self.unchanged_polls)
+            self.update_usage(now)
+            return
         self.unknown = []
-        ret = self.http_get('status')
+        ret = None
+        if body is not None:
+            try:
+                ret = json.loads(body)
+            except ValueError as e:
+                self.log_sampler.log(
+                    self.log, 'ERROR', 'status', 'Invalid status: {error}', error=e
+                )
         if ret is not None:
+            software_version = self.software_version
             data = ret['RESULT']
             self.software_version = ret['sw']['V']
             self.uid = ret['UID']
@@ -269,19 +502,88 @@ class SC23DCI:
             self.unknown.append({"uscm": data['uscm']})
             # lastRefresh (data x ms old?)
             self.unknown.append({"lastRefresh": data['lastRefresh']})
+            # only a fully decoded status may be skipped by the following polls
+            self.confirmed_state = data
+            self.status_fingerprint = fingerprint
+            self.last_full_refresh = time.monotonic()
 
             backlogs = self.change_backlog
             self.change_backlog = []
-            for backlog in backlogs:
-                if data[backlog['key']] != backlog['value']:
-                    if backlog['arg'] is None:
-                        backlog['func']()
-                    else:
-                        backlog['func'](backlog['arg'])
-
-            if self.mqtt_client != 0 and len(self.mqtt_list) > 0:
+            self.request_context.priority = Priority.CONFIRMATION
+            try:
+                for backlog in backlogs:
+                    if data[backlog['key']] != backlog['value']:
+                        if backlog['arg'] is None:
+                            backlog['func']()
+                        else:
+                            backlog['func'](backlog['arg'])
+            finally:
+                del self.request_context.priority
+
+            if self.mqtt_client is not None and len(self.mqtt_list) > 0:
                 self.mqtt_publish()
-        logger.debug(self)
+            # the device was not polled yet when it was announced or its firmware changed
+            if self.mqtt_client is not None and self.software_version != software_version:
+                self.mqtt_home_assistant_autodiscover()
+            self.update_usage(now)
+        self.log.opt(lazy=True).debug('{}', lambda: repr(self))
+
+    def update_usage(self, now: float | None = None):
+        """
+        Accounts the confirmed state of the last poll in the usage aggregates.
+        Every usage_publish_interval the aggregates are persisted and published.
+        :param now: The time of the poll, defaults to the current time
+        """
+        self.usage.update(self.confirmed_state, now)
+        if time.monotonic() - self.last_usage_publish < self.usage_publish_interval:
+            return
+        self.last_usage_publish = time.monotonic()
+        self.usage.save()
+        if self.mqtt_client is None:
+            return
+        for pub in self.mqtt_list:
+            if pub['_id'] == 'usage':
+                self.mqtt_client.publish(
+                    pub['topic'],
+                    payload=json.dumps(self.usage.summary()),
+                    retain=True
+                )
+
+    def set_resolver(self, resolver: Callable[[str], str | None], uid: str | None = None):
+        """
+        Enables resolving the ip of the device by its UID when polls keep failing
+        :param resolver: Looks up the ip of a UID. eg.: Discovery.resolve
+        :param uid: The UID of the device, defaults to the UID of the last poll
+        """
+        self.resolver = resolver
+        if uid is not None:
+            self.uid = uid
+
+    def resolve(self) -> bool:
+        """
+        Looks up the ip of the device by its UID and updates the API url
+        :return: True if the ip changed
+        """
+        self.http_failures = 0
+        if self.resolver is None or self.uid is None:
+            if self.req_base_url is None:
+                self.log_sampler.log(
+                    self.log, 'ERROR', 'resolve', 'Device without ip can not be resolved'
+                )
+            return False
+        ip = self.resolver(self.uid)
+        if ip is None:
+            self.log_sampler.log(
+                self.log, 'WARNING', 'resolve', 'Device {uid} not found', uid=self.uid
+            )
+            return False
+        req_base_url = f"http://{ip}/api/v/1/"
+        if req_base_url == self.req_base_url:
+            return False
+        self.log.info('Device {uid} resolved to {ip}', uid=self.uid, ip=ip)
+        self.req_base_url = req_base_url
+        self.status_fingerprint = None
+        return True
 
     def add_backlog(self, func, arg, key, value):
         """
@@ -294,12 +596,30 @@ class SC23DCI:
         :param key: The unique key to identify the item in the backlog
         :param value: The value to be written to the device
         """
-        backlogs = self.change_backlog
-        for backlog in backlogs:
-            if backlog['func'] == func:
-                self.change_backlog.remove(backlog)
+        self.change_backlog = [
+            backlog for backlog in self.change_backlog if backlog['key'] != key
+        ]
         self.change_backlog.append({'func': func, 'arg': arg, 'key': key, 'value': value})
 
+    def is_redundant_write(self, key: str, value) -> bool:
+        """
+        Checks if a write would not change the device.
+        A pending write in the backlog takes precedence over the last confirmed state.
+        Redundant writes are counted in suppressed_writes.
+        :param key: The key of the value in the status RESULT. eg.: fs
+        :param value: The value to be written to the device
+        :return: True if the write can be skipped
+        """
+        current = self.confirmed_state.get(key)
+        for backlog in self.change_backlog:
+            if backlog['key'] == key:
+                current = backlog['value']
+        if current is None or current != value:
+            return False
+        self.suppressed_writes += 1
+        self.log.debug('Suppressed redundant write {key}={value}', key=key, value=value)
+        return True
+
     def clear_ssids(self):
         """
         clears the ssid list
@@ -311,11 +631,10 @@ class SC23DCI:
         API Getter for the Wi-Fi SSIDs
         :return: The List of SSIDs or None
         """
-        ret = self.http_get('network/scan')
-        data = ret['RESULT']
+        ret = self.http_get('network/scan', Priority.SCAN)
         if ret is None:
             return None
-        for wifi in data:
+        for wifi in ret['RESULT']:
             if wifi not in self.wifi:
                 self.wifi.append(Wifi(wifi))
         return self.wifi
@@ -334,21 +653,28 @@ class SC23DCI:
     def switch_on(self):
         """
         Sends Power on request to the API
+        :return: True if the device accepted the request or already is in that state
         """
+        if self.is_redundant_write('ps', 1):
+            return True
         self.add_backlog(self.switch_on, None, 'ps', 1)
-        self.http_post('power/on')
+        return self.http_post('power/on') is not None
 
     def switch_off(self):
         """
         Sends Power off request to the API
+        :return: True if the device accepted the request or already is in that state
         """
+        if self.is_redundant_write('ps', 0):
+            return True
         self.add_backlog(self.switch_off, None, 'ps', 0)
-        self.http_post('power/off')
+        return self.http_post('power/off') is not None
 
     def set_temperature(self, set_point: float | int):
         """
         Sends temperature set point request to the API
         :param set_point: The target temperature in °C
+        :return: True if the device accepted the request or already is in that state
         """
         set_point = round(
             max(
@@ -359,51 +685,66 @@ class SC23DCI:
                 float(Env.get_env('SC23DCI_MIN_TEMP_C'))
             )
         )
+        if self.is_redundant_write('sp', set_point):
+            return True
         self.add_backlog(self.set_temperature, set_point, 'sp', set_point)
-        self.http_post('set/setpoint', {'p_temp': set_point})
+        return self.http_post('set/setpoint', {'p_temp': set_point}) is not None
 
     def set_fan_speed(self, speed: int):
         """
         Sends fan speed request to the API
         :param speed: The fanspeed auto:0, speed: 1-3
+        :return: True if the device accepted the request or already is in that state
         """
         speed = max(min(speed, 3), 0)
+        if self.is_redundant_write('fs', speed):
+            return True
         self.add_backlog(self.set_fan_speed, speed, 'fs', speed)
-        self.http_post('set/fan', {'value': speed})
+        return self.http_post('set/fan', {'value': speed}) is not None
 
     def set_flap_rotation(self, rotate: int):
         """
         Sends flap rotation request to the API
         :param rotate: Rotate: 0, fixed: 7
+        :return: True if the device accepted the request or already is in that state
         """
         mode = 0 if rotate else 7
+        if self.is_redundant_write('fr', mode):
+            return True
         self.add_backlog(self.set_flap_rotation, rotate, 'fr', mode)
-        self.http_post('set/feature/rotation', {'value': mode})
+        return self.http_post('set/feature/rotation', {'value': mode}) is not None
 
     def set_night_mode(self, night: int):
         """
         Sends night mode request to the API
         :param night: Night mode 1: on, 0: off
+        :return: True if the device accepted the request or already is in that state
         """
         if night not in [0, 1]:
-            return
+            return False
+        if self.is_redundant_write('nm', night):
+            return True
         self.add_backlog(self.set_night_mode, night, 'nm', night)
-        self.http_post('set/feature/night', {'value': night})
+        return self.http_post('set/feature/night', {'value': night}) is not None
 
     def set_timeplan_mode(self, mode: int):
         """
         Sends timeplan mode request to the API
         :param mode: Timeplan mode true: on, false: off
+        :return: True if the device accepted the request or already is in that state
         """
         endpoint = 'on' if mode else 'off'
+        if self.is_redundant_write('cm', (1 if mode else 0)):
+            return True
         self.add_backlog(self.set_timeplan_mode, mode, 'cm', (1 if mode else 0))
-        self.http_post('set/calendar/' + endpoint)
+        return self.http_post('set/calendar/' + endpoint) is not None
 
     def set_working_mode(self, mode: int):
         """
         Sends working mode request to the API
         :param mode: the target working mode.
         heating:0, cooling:1, dehumidification:3, fan_only:4, auto:5"
+        :return: True if the device accepted the request or already is in that state
         """
 
         endpoint = ['heating', 'cooling', '', 'dehumidification', 'fanonly', 'auto']
@@ -411,11 +752,14 @@ class SC23DCI:
             logger.warning(
                 f"{mode} not allowed. heating:0, cooling:1, dehumidification:3, fan_only:4, auto:5"
             )
-            return
+            return False
+        powered = True
         if self.power_state == 0:
-            self.switch_on()
+            powered = self.switch_on()
+        if self.is_redundant_write('wm', mode):
+            return powered
         self.add_backlog(self.set_working_mode, mode, 'wm', mode)
-        self.http_post('set/mode/' + endpoint[mode])
+        return self.http_post('set/mode/' + endpoint[mode]) is not None and powered
 
     def set_mode_auto(self):
         """
@@ -448,45 +792,80 @@ class SC23DCI:
         self.set_working_mode(0)
 
     # mqtt section
+    def topic(self, key: str) -> str:
+        """
+        Getter for the MQTT topics of this device.
+        Devices of a fleet insert their device_id after the first level.
+        eg.: sc23dci/<device_id>/all
+        :param key: The env key of the topic. eg.: MQTT_TOPIC_ALL
+        :return: The topic
+        """
+        topic = Env.get_env(key)
+        if self.device_id is None:
+            return topic
+        root, separator, rest = topic.partition('/')
+        return f"{root}/{self.device_id}{separator}{rest}"
+
+    def mqtt_all_payload(self) -> dict:
+        """
+        The summary published on the all topic
+        :return: The summary
+        """
+        return {
+            "set_point": self.set_point,
+            "working_mode": self.working_mode,
+            "power_state": self.power_state,
+            "mode": self.working_mode if self.power_state == 1 else 6,
+            "fan_speed": self.fan_speed,
+            "flap_rotate": self.flap_rotate,
+            "timeplan_mode": self.timeplan_mode,
+            "temperature": self.temperature,
+            "night_mode": self.night_mode,
+            "timer_status": self.timer_status,
+            "heating_disabled": self.heating_disabled,
+            "cooling_disabled": self.cooling_disabled,
+            "hotel_mode": self.hotel_mode,
+            "uptime": self.uptime,
+            "software_version": self.software_version,
+            "time": (
+                self.date_time.isoformat()
+                if isinstance(self.date_time, datetime) else self.date_time
+            ),
+            "uid": self.uid,
+            "device_type": self.device_type,
+            "ip": self.ip,
+            "subnet": self.subnet,
+            "gateway": self.gateway,
+            "dhcp": self.dhcp,
+            "serial": self.serial,
+            "name": self.name,
+            "wifi": self.wifi,
+            "mqttSubList": self.mqtt_list,
+            "suppressed_writes": self.suppressed_writes
+        }
+
     def mqtt_publish(self):
         """
         Publisher for MQTT
         """
+        # the summary is built once for the all and the all_compact topic
+        payload = {}
+        if any(pub['_id'] in ['all', 'all_compact'] for pub in self.mqtt_list):
+            payload = self.mqtt_all_payload()
         for pub in self.mqtt_list:
             if pub['_id'] == 'temperature':
                 self.mqtt_client.publish(pub['topic'], payload=self.temperature)
             if pub['_id'] == 'powerstate':
                 self.mqtt_client.publish(pub['topic'], payload=self.power_state)
             if pub['_id'] == 'all':
-                all_payload = {
-                    "set_point": self.set_point,
-                    "working_mode": self.working_mode,
-                    "power_state": self.power_state,
-                    "mode": self.working_mode if self.power_state == 1 else 6,
-                    "fan_speed": self.fan_speed,
-                    "flap_rotate": self.flap_rotate,
-                    "timeplan_mode": self.timeplan_mode,
-                    "temperature": self.temperature,
-                    "night_mode": self.night_mode,
-                    "timer_status": self.timer_status,
-                    "heating_disabled": self.heating_disabled,
-                    "cooling_disabled": self.cooling_disabled,
-                    "hotel_mode": self.hotel_mode,
-                    "uptime": self.uptime,
-                    "software_version": self.software_version,
-                    "time": self.date_time.isoformat(),
-                    "uid": self.uid,
-                    "device_type": self.device_type,
-                    "ip": self.ip,
-                    "subnet": self.subnet,
-                    "gateway": self.gateway,
-                    "dhcp": self.dhcp,
-                    "serial": self.serial,
-                    "name": self.name,
-                    "wifi": self.wifi,
-                    "mqttSubList": self.mqtt_list
-                }
-                self.mqtt_client.publish(pub['topic'], payload=json.dumps(all_payload))
+                self.mqtt_client.publish(pub['topic'], payload=json.dumps(payload))
+            if pub['_id'] == 'all_compact':
+                compact_payload = dict(payload)
+                compact_payload['wifi'] = [
+                    [wifi.essid, wifi.signal, wifi.password] for wifi in self.wifi
+                ]
+                del compact_payload['mqttSubList']
+                self.mqtt_client.publish(pub['topic'], payload=encode_all(compact_payload))
 
     def mqtt_on_connect(self, client, userdata, flags, rc):  # pylint: disable=unused-argument
         """
@@ -497,9 +876,12 @@ class SC23DCI:
         :param rc:
         :return:
         """
-        logger.info(f"MQTT connected with result code {rc}")
+        self.log.info('MQTT connected with result code {rc}', rc=rc)
+        self.log_sampler.reset('mqtt')
+        # publish the full state with the next poll
+        self.status_fingerprint = None
         self.mqtt_subscribe_to_all_topics()
-        self.mqtt_client.publish(Env.get_env('MQTT_TOPIC_LWT'), payload='online', retain=True)
+        self.mqtt_client.publish(self.topic('MQTT_TOPIC_LWT'), payload='online', retain=True)
         self.mqtt_home_assistant_autodiscover()
 
     def mqtt_on_disconnect(self, client, userdata, flags, rc):  # pylint: disable=unused-argument
@@ -511,7 +893,9 @@ class SC23DCI:
         :param rc:
         :return:
         """
-        logger.info(f"MQTT disconnected with result code {rc}")
+        self.log_sampler.log(
+            self.log, 'INFO', 'mqtt', 'MQTT disconnected with result code {rc}', rc=rc
+        )
 
     def set_mqtt_client(self, broker: str, port: str | int):
         """
@@ -523,10 +907,21 @@ class SC23DCI:
         # self.mqtt_client.enable_logger(logger=logger)
         self.mqtt_client.on_connect = self.mqtt_on_connect
         self.mqtt_client.on_disconnect = self.mqtt_on_disconnect
-        self.mqtt_client.will_set(Env.get_env('MQTT_TOPIC_LWT'), payload='offline', retain=True)
+        self.mqtt_client.will_set(self.topic('MQTT_TOPIC_LWT'), payload='offline', retain=True)
         self.mqtt_client.connect(broker, int(port))
         self.mqtt_client.loop_start()
 
+    def use_mqtt_client(self, client: mqtt.Client, worker_lwt_topic: str | None = None):
+        """
+        Shares an MQTT client with other devices.
+        The owner of the client has to call mqtt_on_connect of every device on connect.
+        :param client: The connected MQTT client
+        :param worker_lwt_topic: The LWT topic of the client,
+        Home Assistant reports the device as unavailable when either LWT is offline
+        """
+        self.mqtt_client = client
+        self.worker_lwt_topic = worker_lwt_topic
+
     def mqtt_enable_publish(self, topic: str, _id: str):
         """
         Enables publishing for topic
@@ -576,6 +971,28 @@ class SC23DCI:
         """
         self.mqtt_enable_publish(topic, 'all')
 
+    def mqtt_enable_publish_all_compact(self, topic: str):
+        """
+        Enables publishing of the summary as short-key CBOR, see sc23dci.compact.decode_all
+        :param topic: The topic to enable publish on
+        """
+        self.mqtt_enable_publish(topic, 'all_compact')
+
+    def mqtt_enable_publish_usage(self, topic: str):
+        """
+        Enables publishing of the usage aggregates every usage_publish_interval
+        :param topic: The topic to enable publish on
+        """
+        self.mqtt_enable_publish(topic, 'usage')
+
+    def mqtt_add_subscription(self, topic: str, cb):
+        """
+        Adds a subscription that is renewed with every connect
+        :param topic: The topic to subscribe to
+        :param cb: The callback function -> (client, userdata, msg)
+        """
+        self.mqtt_subscriptions.append((topic, cb))
+
     def mqtt_subscribe_to_all_topics(self):
         """
         Wrapper to bundle all subscribe calls into one function
@@ -596,29 +1013,31 @@ class SC23DCI:
             )
             self.mqtt_home_assistant_autodiscover()
         self.mqtt_subscribe(
-            Env.get_env('MQTT_TOPIC_POWERSTATE_SET'),
+            self.topic('MQTT_TOPIC_POWERSTATE_SET'),
             self.on_mqtt_power_state
         )
         self.mqtt_subscribe(
-            Env.get_env('MQTT_TOPIC_MODE_SET'),
+            self.topic('MQTT_TOPIC_MODE_SET'),
             self.on_mqtt_mode
         )
         self.mqtt_subscribe(
-            Env.get_env('MQTT_TOPIC_SETPOINT_SET'),
+            self.topic('MQTT_TOPIC_SETPOINT_SET'),
             self.on_mqtt_setpoint
         )
         self.mqtt_subscribe(
-            Env.get_env('MQTT_TOPIC_FLAP_MODE_SET'),
+            self.topic('MQTT_TOPIC_FLAP_MODE_SET'),
             self.on_mqtt_flap_mode
         )
         self.mqtt_subscribe(
-            Env.get_env('MQTT_TOPIC_FAN_SPEED_SET'),
+            self.topic('MQTT_TOPIC_FAN_SPEED_SET'),
             self.on_mqtt_fan_speed
         )
         self.mqtt_subscribe(
-            Env.get_env('MQTT_TOPIC_NIGHT_MODE_SET'),
+            self.topic('MQTT_TOPIC_NIGHT_MODE_SET'),
             self.on_mqtt_night_mode
         )
+        for topic, cb in self.mqtt_subscriptions:
+            self.mqtt_subscribe(topic, cb)
 
     def mqtt_subscribe(self, topic: str, cb):
         """
@@ -627,9 +1046,56 @@ class SC23DCI:
         :param cb: The callback function -> (client, userdata, msg)
         """
         if self.mqtt_client is not None:
+            if self.recorder is not None:
+                cb = self.recorder.wrap_mqtt_callback(cb)
             self.mqtt_client.subscribe(topic)
             self.mqtt_client.message_callback_add(topic, cb)
 
+    # pylint: disable-next=too-many-return-statements, too-many-branches
+    def apply_command(self, command: str, value) -> bool:
+        """
+        Applies a command like the MQTT setter topics do
+        :param command: power_state | mode | set_point | fan_speed | flap_mode | night_mode
+        :param value: The value as number, name or MQTT payload. eg.: 1 | 'cooling' | b'on'
+        :return: True if the device accepted the command or already is in that state
+        """
+        try:
+            value = int(float(value))
+        except (ValueError, TypeError):
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+        match command:
+            case 'power_state':
+                if value in [0, 'off']:
+                    return self.switch_off()
+                if isinstance(value, int) or value == 'on':
+                    return self.switch_on()
+            case 'mode':
+                if value in ['off', 6]:
+                    return self.switch_off()
+                endpoint = ['heating', 'cooling', '', 'dehumidification', 'fanonly', 'auto']
+                if value in endpoint:
+                    return self.set_working_mode(endpoint.index(value))
+                if isinstance(value, int):
+                    return self.set_working_mode(value)
+            case 'set_point':
+                if isinstance(value, int):
+                    return self.set_temperature(value)
+            case 'fan_speed':
+                value = {'auto': 0, 'low': 1, 'medium': 2, 'high': 3}.get(value, value)
+                if isinstance(value, int):
+                    return self.set_fan_speed(value)
+            case 'flap_mode':
+                value = {'off': 7, 'on': 0}.get(value, value)
+                if isinstance(value, int):
+                    return self.set_flap_rotation(value)
+            case 'night_mode':
+                value = {'off': 0, 'on': 1}.get(value, value)
+                if isinstance(value, int):
+                    return self.set_night_mode(value)
+        self.log.warning('Invalid command {command}: {value}', command=command, value=value)
+        return False
+
     def on_mqtt_flap_mode(self, client, userdata, msg):  # pylint: disable=unused-argument
         """
         The callback of the flap mode setter subscribe
@@ -637,15 +1103,7 @@ class SC23DCI:
         :param userdata:
         :param msg: The message with payload
         """
-        try:
-            target_mode = int(float(msg.payload))
-        except (ValueError, TypeError):
-            target_mode = msg.payload.decode('utf-8')
-        if target_mode == 'off':
-            target_mode = 7
-        elif target_mode == 'on':
-            target_mode = 0
-        self.set_flap_rotation(target_mode)
+        self.apply_command('flap_mode', msg.payload)
 
     def on_mqtt_night_mode(self, client, userdata, msg):  # pylint: disable=unused-argument
         """
@@ -654,15 +1112,7 @@ class SC23DCI:
         :param userdata:
         :param msg: The message with payload
         """
-        try:
-            target_mode = int(float(msg.payload))
-        except (ValueError, TypeError):
-            target_mode = msg.payload.decode('utf-8')
-        if target_mode == 'off':
-            target_mode = 0
-        elif target_mode == 'on':
-            target_mode = 1
-        self.set_night_mode(target_mode)
+        self.apply_command('night_mode', msg.payload)
 
     def on_mqtt_fan_speed(self, client, userdata, msg):  # pylint: disable=unused-argument
         """
@@ -671,20 +1121,7 @@ class SC23DCI:
         :param userdata:
         :param msg: The message with payload
         """
-        try:
-            target_speed = int(float(msg.payload))
-        except (ValueError, TypeError):
-            target_speed = msg.payload.decode('utf-8')
-        match target_speed:
-            case 'auto':
-                target_speed = 0
-            case 'low':
-                target_speed = 1
-            case 'medium':
-                target_speed = 2
-            case 'high':
-                target_speed = 3
-        self.set_fan_speed(target_speed)
+        self.apply_command('fan_speed', msg.payload)
 
     def on_mqtt_power_state(self, client, userdata, msg):  # pylint: disable=unused-argument
         """
@@ -693,19 +1130,7 @@ class SC23DCI:
         :param userdata:
         :param msg: The message with payload
         """
-        try:
-            target_state = int(float(msg.payload))
-        except (ValueError, TypeError):
-            target_state = int(float(msg.payload.decode('utf-8')))
-        match target_state:
-            case 'off':
-                target_state = 0
-            case 'on':
-                target_state = 1
-        if int(float(target_state)) == 0:
-            self.switch_off()
-        else:
-            self.switch_on()
+        self.apply_command('power_state', msg.payload)
 
     def on_mqtt_mode(self, client, userdata, msg):  # pylint: disable=unused-argument
         """
@@ -714,17 +1139,7 @@ class SC23DCI:
         :param userdata:
         :param msg: The message with payload
         """
-        try:
-            mode = int(float(msg.payload))
-        except (ValueError, TypeError):
-            mode = msg.payload.decode('utf-8')
-
-        if mode in ['off', 6]:
-            self.switch_off()
-            return
-        endpoint = ['heating', 'cooling', '', 'dehumidification', 'fanonly', 'auto']
-        if mode in endpoint:
-            self.set_working_mode(endpoint.index(mode))
+        self.apply_command('mode', msg.payload)
 
     def on_mqtt_setpoint(self, client, userdata, msg):  # pylint: disable=unused-argument
         """
@@ -733,10 +1148,7 @@ class SC23DCI:
         :param userdata:
         :param msg: The message with payload
         """
-        try:
-            self.set_temperature(int(float(msg.payload)))
-        except (ValueError, TypeError):
-            self.set_temperature(int(float(msg.payload.decode('utf-8'))))
+        self.apply_command('set_point', msg.payload)
 
     def mqtt_home_assistant_autodiscover(self):
         """
@@ -747,15 +1159,19 @@ class SC23DCI:
         discovery_prefix = Env.get_env('MQTT_HASSIO_TOPIC')
         component = 'climate'
         object_id = Env.get_env('MQTT_HASSIO_OBJECT_ID')
+        name = 'SC23DCI'
+        if self.device_id is not None:
+            object_id = f"SC23DCI-{self.device_id}"
+            name = f"SC23DCI {self.device_id}"
         config = {
-            'name': 'SC23DCI',
+            'name': name,
             'unique_id': object_id,
             'modes': ['heat', 'cool', 'dry', 'fan_only', 'auto', 'off'],
             'max_temp': float(Env.get_env('SC23DCI_MAX_TEMP_C')),
             'min_temp': float(Env.get_env('SC23DCI_MIN_TEMP_C')),
             'temperature_unit': 'C',
-            'availability_topic': Env.get_env('MQTT_TOPIC_LWT'),
-            'mode_command_topic': Env.get_env('MQTT_TOPIC_MODE_SET'),
+            'availability_topic': self.topic('MQTT_TOPIC_LWT'),
+            'mode_command_topic': self.topic('MQTT_TOPIC_MODE_SET'),
             'mode_command_template': "{{"
                                      " ['heating', 'cooling', 'dehumidification', "
                                      "'fanonly', 'auto', 'off']"
@@ -764,37 +1180,44 @@ class SC23DCI:
                                      " if value in ['heat', 'cool', 'dry', 'fan_only', "
                                      "'auto', 'off'] else value "
                                      "}}",
-            'mode_state_topic': Env.get_env('MQTT_TOPIC_ALL'),
+            'mode_state_topic': self.topic('MQTT_TOPIC_ALL'),
             'mode_state_template': "{{"
                                    " ['heat', 'cool', '', 'dry', 'fan_only', "
                                    "'auto', 'off']"
                                    "[value_json.mode|int] if value_json.mode|int in "
                                    "[0, 1, 3, 4, 5, 6] else value "
                                    "}}",
-            'swing_mode_state_topic': Env.get_env('MQTT_TOPIC_ALL'),
+            'swing_mode_state_topic': self.topic('MQTT_TOPIC_ALL'),
             'swing_mode_state_template': "{{"
                                          " ['on', '', '', '', '', '', '', 'off']"
                                          "[value_json.flap_rotate|int]"
                                          " if value_json.flap_rotate|int in [0, 7] else value "
                                          "}}",
-            'swing_mode_command_topic': Env.get_env('MQTT_TOPIC_SETPOINT_SET'),
+            'swing_mode_command_topic': self.topic('MQTT_TOPIC_SETPOINT_SET'),
             'swing_mode_command_template': "{{ value }}",
-            'fan_mode_state_topic': Env.get_env('MQTT_TOPIC_ALL'),
+            'fan_mode_state_topic': self.topic('MQTT_TOPIC_ALL'),
             'fan_mode_state_template': "{{"
                                        " ['auto', 'low', 'medium', 'high']"
                                        "[value_json.fan_speed|int]"
                                        " if value_json.fan_speed|int in "
                                        "[0, 1, 2, 3] else value "
                                        "}}",
-            'fan_mode_command_topic': Env.get_env('MQTT_TOPIC_SETPOINT_SET'),
+            'fan_mode_command_topic': self.topic('MQTT_TOPIC_SETPOINT_SET'),
             'fan_mode_command_template': "{{ value }}",
-            'temperature_command_topic': Env.get_env('MQTT_TOPIC_SETPOINT_SET'),
+            'temperature_command_topic': self.topic('MQTT_TOPIC_SETPOINT_SET'),
             'temperature_command_template': "{{ value }}",
-            'temperature_state_topic': Env.get_env('MQTT_TOPIC_ALL'),
+            'temperature_state_topic': self.topic('MQTT_TOPIC_ALL'),
             'temperature_state_template': "{{ value_json.set_point }}",
-            'current_temperature_topic': Env.get_env('MQTT_TOPIC_ALL'),
+            'current_temperature_topic': self.topic('MQTT_TOPIC_ALL'),
             'current_temperature_template': "{{ value_json.temperature }}",
             'sw_version': self.software_version
         }
+        if self.worker_lwt_topic is not None:
+            del config['availability_topic']
+            config['availability'] = [
+                {'topic': self.topic('MQTT_TOPIC_LWT')},
+                {'topic': self.worker_lwt_topic}
+            ]
+            config['availability_mode'] = 'all'
         topic = f'{discovery_prefix}/{component}/{object_id}/config'
         self.mqtt_client.publish(topic, payload=json.dumps(config))
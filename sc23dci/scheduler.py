@@ -0,0 +1,216 @@
+"""
+Scheduler Module
+Timer heap scheduler for the periodic polls of the devices
+"""
+import heapq
+import itertools
+import random
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from loguru import logger
+
+from env.env import Env
+from sc23dci.log_sampler import LogSampler
+
+
+class Job:  # pylint: disable=too-few-public-methods, too-many-instance-attributes
+    """
+    A function that is called periodically
+    """
+
+    def __init__(self, job_id: str, func: Callable[[], object], interval: float, next_run: float):
+        """
+        :param job_id: The unique id of the job. eg.: the device id
+        :param func: The function to call
+        :param interval: The interval in seconds
+        :param next_run: The monotonic time of the next run
+        """
+        self.id = job_id  # pylint: disable=invalid-name
+        self.func = func
+        self.interval = interval
+        self.next_run = next_run
+        # identifies the current heap entry, older entries of a rescheduled job are skipped
+        self.seq = -1
+        self.running = False
+        self.runs = 0
+        self.misfires = 0
+
+    def __repr__(self):
+        return (
+            f"(Job: {self.id}, Interval: {self.interval}s, Runs: {self.runs}, "
+            f"Misfires: {self.misfires})"
+        )
+
+
+# pylint: disable=too-many-instance-attributes
+class Scheduler:
+    """
+    Runs periodic jobs from a heap ordered by their next run time.
+    Jobs start at a random phase of their interval, so the polls of many devices are spread
+    instead of hitting the network at the same time.
+    Runs are skipped when they are late by more than misfire_grace_time
+    or while the previous run of the job is still busy. Missed runs are not caught up.
+    """
+
+    def __init__(self, workers: int = 1, misfire_grace_time: float = 1.0):
+        """
+        :param workers: The number of jobs running at the same time,
+        1 runs the jobs in the thread of start without a thread pool
+        :param misfire_grace_time: The time in seconds a run may be late
+        """
+        self.misfire_grace_time = misfire_grace_time
+        self.heap: list[tuple[float, int, Job]] = []
+        self.jobs: dict[str, Job] = {}
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.running = False
+        # a device that fails on every poll logs its traceback once per interval
+        self.log_sampler = LogSampler(float(Env.get_env('SC23DCI_LOG_SAMPLE_INTERVAL')))
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='sc23dci-scheduler'
+        ) if workers > 1 else None
+
+    def push(self, job: Job):
+        """
+        Adds the next run of a job to the heap, the lock has to be held
+        :param job: The job
+        """
+        job.seq = next(self.counter)
+        heapq.heappush(self.heap, (job.next_run, job.seq, job))
+        self.condition.notify()
+
+    def add_job(
+            self,
+            job_id: str,
+            func: Callable[[], object],
+            interval: float,
+            phase: float | None = None
+    ) -> Job:
+        """
+        Adds a periodic job
+        :param job_id: The unique id of the job. eg.: the device id
+        :param func: The function to call
+        :param interval: The interval in seconds
+        :param phase: The delay of the first run in seconds, random within the interval if None
+        :raises ValueError: The id is already scheduled
+        :return: The job
+        """
+        if phase is None:
+            phase = random.uniform(0, interval)
+        with self.condition:
+            if job_id in self.jobs:
+                raise ValueError(f"Job {job_id} is already scheduled")
+            job = Job(job_id, func, interval, time.monotonic() + phase)
+            self.jobs[job_id] = job
+            self.push(job)
+        return job
+
+    def reschedule(self, job_id: str, interval: float):
+        """
+        Changes the interval of a job at runtime.
+        The next run keeps the phase of the last run. eg.: a shorter interval runs sooner
+        :param job_id: The id of the job
+        :param interval: The new interval in seconds
+        :raises KeyError: The job is not scheduled
+        """
+        with self.condition:
+            job = self.jobs[job_id]
+            job.next_run = max(job.next_run - job.interval + interval, time.monotonic())
+            job.interval = interval
+            self.push(job)
+
+    def remove_job(self, job_id: str):
+        """
+        Removes a job, a running call is finished
+        :param job_id: The id of the job
+        """
+        with self.condition:
+            self.jobs.pop(job_id, None)
+
+    def next_due(self) -> tuple[Job | None, float | None]:
+        """
+        Takes the next job that is due from the heap and schedules its following run.
+        The lock has to be held.
+        :return: The due job or None and the time in seconds until the next job is due
+        """
+        now = time.monotonic()
+        while self.heap:
+            next_run, seq, job = self.heap[0]
+            if job.seq != seq or self.jobs.get(job.id) is not job:
+                heapq.heappop(self.heap)
+                continue
+            if next_run > now:
+                return None, next_run - now
+            heapq.heappop(self.heap)
+            # fixed rate, the runs missed while the process stalled are coalesced into this one
+            missed = max(0, int((now - next_run) // job.interval))
+            job.next_run = next_run + (missed + 1) * job.interval
+            self.push(job)
+            if job.running or now - next_run > self.misfire_grace_time:
+                job.misfires += 1
+                logger.debug('Skipped run of job {}, late by {:.3f}s', job.id, now - next_run)
+                continue
+            return job, None
+        return None, None
+
+    def execute(self, job: Job):
+        """
+        Runs a job, errors are logged and do not stop the job
+        :param job: The job
+        """
+        try:
+            job.func()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.log_sampler.log(
+                logger,
+                'ERROR',
+                job.id,
+                'Job {job} failed: {error}',
+                exception=e,
+                job=job.id,
+                error=e
+            )
+        finally:
+            job.runs += 1
+            job.running = False
+
+    def start(self):
+        """
+        Runs the jobs until shutdown is called, blocks the calling thread.
+        Returns after the running jobs finished.
+        """
+        self.running = True
+        while self.running:
+            with self.condition:
+                job, timeout = self.next_due()
+                if job is None:
+                    self.condition.wait(timeout)
+                    continue
+                job.running = True
+            if self.executor is None:
+                self.execute(job)
+            else:
+                self.executor.submit(self.execute, job)
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def shutdown(self, signum=None, frame=None):  # pylint: disable=unused-argument
+        """
+        Stops start, safe to be called from a signal handler
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def install_signal_handler(self):
+        """
+        Shuts down on SIGTERM and SIGINT. eg.: on docker stop or when a fleet worker is stopped.
+        Has to be called from the main thread.
+        """
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
@@ -0,0 +1,191 @@
+"""
+Usage Module
+Incremental runtime and duty cycle aggregates of a device, eg. for billing
+"""
+import atexit
+import json
+import os
+import threading
+import time
+
+from loguru import logger
+
+# working modes of the status RESULT wm
+WORKING_MODES = {
+    0: 'heating',
+    1: 'cooling',
+    3: 'dehumidification',
+    4: 'fan_only',
+    5: 'auto'
+}
+
+
+# pylint: disable=too-many-instance-attributes
+class Usage:
+    """
+    Streaming aggregates of the polled state.
+    Every poll closes the interval since the previous poll and accounts it to the state seen
+    at the start of the interval. Intervals longer than max_gap, eg. while the device or the
+    agent was offline, are not accounted.
+    The totals only grow, consumers bill the difference between two summaries.
+    The unit only heats or cools while the CP contacts are connected (cp 0). While they are open
+    (cp 1) a powered on unit is blocked, so only connected time counts as operating.
+    """
+    # a room temperature within this distance in °C to the set point counts as at set point
+    set_point_tolerance: float = 0.5
+
+    def __init__(self, path: str = '', max_gap: float = 300):
+        """
+        :param path: The path of the file the aggregates are persisted to, empty to keep them
+        in memory
+        :param max_gap: The maximum time in seconds between two polls that is accounted
+        """
+        self.path = path
+        self.max_gap = max_gap
+        self.lock = threading.Lock()
+        self.since = time.time()
+        # seconds by aggregate, modes holds the seconds operating by working mode
+        self.seconds: dict[str, float] = {
+            'observed': 0.0,
+            'on': 0.0,
+            'operating': 0.0,
+            'at_set_point': 0.0,
+            'heating_resistance': 0.0,
+            'cp_blocked': 0.0
+        }
+        self.modes: dict[str, float] = {name: 0.0 for name in WORKING_MODES.values()}
+        self.on_cycles = 0
+        self.last_sample: list | None = None
+        self.last_time = 0.0
+        self.load()
+        if path:
+            atexit.register(self.save)
+
+    def __repr__(self):
+        return f"(Usage: {self.seconds}, Modes: {self.modes}, On cycles: {self.on_cycles})"
+
+    @staticmethod
+    def sample(state: dict) -> list:
+        """
+        Extracts the accounted values of a status RESULT
+        :param state: The status RESULT
+        :return: power state, working mode, heating resistance, control port (0: connected,
+        1: open), temperature and set point
+        """
+        return [
+            state.get('ps', 0),
+            state.get('wm'),
+            state.get('heatingResistance', 0),
+            state.get('cp', 0),
+            state.get('t'),
+            state.get('sp')
+        ]
+
+    def update(self, state: dict, now: float | None = None):
+        """
+        Accounts the time since the previous poll and remembers the state
+        :param state: The status RESULT of the poll
+        :param now: The time of the poll, defaults to the current time
+        """
+        if not state:
+            return
+        now = time.time() if now is None else now
+        sample = self.sample(state)
+        with self.lock:
+            last = self.last_sample
+            if last is not None:
+                elapsed = now - self.last_time
+                if 0 < elapsed <= self.max_gap:
+                    self.account(last, elapsed)
+                if not last[0] and sample[0]:
+                    self.on_cycles += 1
+            self.last_sample = sample
+            self.last_time = now
+
+    def account(self, sample: list, elapsed: float):
+        """
+        Adds an interval to the aggregates, the lock has to be held
+        :param sample: The state during the interval
+        :param elapsed: The length of the interval in seconds
+        """
+        power_state, working_mode, heating_resistance, control_port, temperature, set_point = sample
+        self.seconds['observed'] += elapsed
+        if heating_resistance:
+            self.seconds['heating_resistance'] += elapsed
+        if not power_state:
+            return
+        self.seconds['on'] += elapsed
+        if control_port != 0:
+            # the open CP contacts block heating and cooling
+            self.seconds['cp_blocked'] += elapsed
+            return
+        self.seconds['operating'] += elapsed
+        mode = WORKING_MODES.get(working_mode)
+        if mode is not None:
+            self.modes[mode] += elapsed
+        if (
+                temperature is not None and set_point is not None
+                and abs(temperature - set_point) <= self.set_point_tolerance
+        ):
+            self.seconds['at_set_point'] += elapsed
+
+    def summary(self) -> dict:
+        """
+        :return: The aggregates in seconds, rounded, and the duty cycle of the operating time
+        """
+        with self.lock:
+            observed = self.seconds['observed']
+            return {
+                'since': round(self.since),
+                'observed': round(observed),
+                'on': round(self.seconds['on']),
+                'operating': round(self.seconds['operating']),
+                'duty_cycle': round(self.seconds['operating'] / observed, 4) if observed else 0.0,
+                'modes': {mode: round(seconds) for mode, seconds in self.modes.items()},
+                'on_cycles': self.on_cycles,
+                'at_set_point': round(self.seconds['at_set_point']),
+                'heating_resistance': round(self.seconds['heating_resistance']),
+                'cp_blocked': round(self.seconds['cp_blocked'])
+            }
+
+    def load(self):
+        """
+        Restores the aggregates from the file
+        """
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                data = json.load(file)
+            self.since = data['since']
+            self.seconds.update(
+                {key: value for key, value in data['seconds'].items() if key in self.seconds}
+            )
+            self.modes.update(data['modes'])
+            self.on_cycles = data['on_cycles']
+            self.last_sample = data['last_sample']
+            self.last_time = data['last_time']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Usage {self.path} not loaded: {e}")
+
+    def save(self):
+        """
+        Writes the aggregates to the file
+        """
+        if not self.path:
+            return
+        with self.lock:
+            data = {
+                'since': self.since,
+                'seconds': self.seconds,
+                'modes': self.modes,
+                'on_cycles': self.on_cycles,
+                'last_sample': self.last_sample,
+                'last_time': self.last_time
+            }
+            try:
+                with open(self.path + '.tmp', 'w', encoding='utf-8') as file:
+                    json.dump(data, file)
+                os.replace(self.path + '.tmp', self.path)
+            except OSError as e:
+                logger.error(f"Usage {self.path} not saved: {e}")